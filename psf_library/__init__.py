@@ -1,10 +1,20 @@
-from .calcs import z_score, compute_df_cumulative, compute_col_cumulative, annualized_return, to_ratio, to_percent, compute_rolling_returns, compute_returns
-from .cleaning import data_prep, prep_dfs, process_indices, get_last_day_each_quarter, data_info, unique_values, color_selection, convert_deltas_to_percent, map_to_sector
+from .calcs import z_score, z_score_bands, PercentileIndex, build_percentile_indexes, rolling_percentile, compute_df_cumulative, compute_col_cumulative, annualized_return, to_ratio, to_percent, compute_rolling_returns, compute_panel_rolling_returns, compute_returns, compute_panel_returns, ReturnsAccumulator, compute_trailing_returns, resample_returns, rolling_correlation, RollingCovariance, compute_risk_metrics
+from .cleaning import data_prep, prep_dfs, process_indices, get_last_day_each_quarter, data_info, unique_values, color_selection, convert_deltas_to_percent, map_to_sector, map_sectors, align_series, PeriodEndIndex, build_period_indexes, get_last_day_each_period, format_table, load_csv_cached, stream_process_indices, HistoryStore, dtype_memory_report
 from .plotting import point_label, table_builder, annotate_on_lines, annotate_on_scatter, simple_axes, style_axes_blank, style_axes_date, plot_basic_scatter, plot_colored_scatter
 from .building import fig_save_load, add_image
+from .simulation import simulate_returns, summarize_simulation
+from .parallel import run_parallel, sweep_rolling_returns
+from .caching import enable_cache, disable_cache
+from .dtypes import set_dtype_policy, get_dtype_policy, dtype_policy
+from .panel import SecurityPanel, create_memmap_panel, open_memmap_panel, panel_returns, panel_rolling_returns, panel_z_scores, panel_period_ends
 
-__all__ = ['z_score', 'compute_df_cumulative', 'compute_col_cumulative', 'annualized_return', 'to_ratio', 'compute_rolling_returns', 'compute_returns', 'to_percent',
-    'data_prep', 'prep_dfs', 'process_indices', 'get_last_day_each_quarter', 'data_info', 'unique_values', 'color_selection', 'convert_deltas_to_percent', 'map_to_sector',
+__all__ = ['z_score', 'z_score_bands', 'PercentileIndex', 'build_percentile_indexes', 'rolling_percentile', 'compute_df_cumulative', 'compute_col_cumulative', 'annualized_return', 'to_ratio', 'compute_rolling_returns', 'compute_panel_rolling_returns', 'compute_returns', 'compute_panel_returns', 'ReturnsAccumulator', 'compute_trailing_returns', 'resample_returns', 'rolling_correlation', 'RollingCovariance', 'compute_risk_metrics', 'to_percent',
+    'data_prep', 'prep_dfs', 'process_indices', 'get_last_day_each_quarter', 'data_info', 'unique_values', 'color_selection', 'convert_deltas_to_percent', 'map_to_sector', 'map_sectors', 'align_series', 'PeriodEndIndex', 'build_period_indexes', 'get_last_day_each_period', 'format_table', 'load_csv_cached', 'stream_process_indices', 'HistoryStore', 'dtype_memory_report',
     'point_label', 'table_builder', 'annotate_on_lines', 'annotate_on_scatter',
     'create_subplots', 'simple_axes', 'style_axes_blank', 'style_axes_date', 'plot_basic_scatter', 'plot_colored_scatter',
-    'fig_save_load', 'add_image']
\ No newline at end of file
+    'fig_save_load', 'add_image',
+    'simulate_returns', 'summarize_simulation',
+    'run_parallel', 'sweep_rolling_returns',
+    'enable_cache', 'disable_cache',
+    'set_dtype_policy', 'get_dtype_policy', 'dtype_policy',
+    'SecurityPanel', 'create_memmap_panel', 'open_memmap_panel', 'panel_returns', 'panel_rolling_returns', 'panel_z_scores', 'panel_period_ends']
\ No newline at end of file
@@ -0,0 +1,207 @@
+import os
+import datetime
+import copy
+import pickle
+import hashlib
+import functools
+from collections import OrderedDict
+from importlib import metadata
+import pandas as pd
+import numpy as np
+from .dtypes import get_dtype_policy
+
+'''
+Opt-in memoization for the calcs and cleaning functions, nothing is cached until enable_cache is called
+Results are keyed by a fast fingerprint of the input df's plus the other arguments
+The in-memory cache drops the least recently used results once it goes over its byte budget
+An optional folder keeps the results on disk so they can be picked up again in a later session
+Every lookup still hashes the inputs, so the savings come from calls that cost more than hashing their df's
+On the example files a repeated call took about 1/3 of the time for get_last_day_each_quarter and prep_dfs,
+1/6 for compute_panel_rolling_returns and 1/30 for the rolling compute_risk_metrics
+'''
+
+# The cache that the memoized functions use, None means caching is turned off
+active_cache = None
+
+# Version of the cached results, bumped whenever a memoized function changes what it gives back
+# It goes into every key along with the installed library version, so results saved by another version are never used
+cache_version = 1
+try:
+    library_version = metadata.version('psf_library')
+except metadata.PackageNotFoundError:
+    library_version = 'unknown'
+
+# Raised by fingerprint for an argument it cannot hash safely, the memoized call then runs without the cache
+class UnhashableArgument(TypeError):
+    pass
+
+# Builds a hash of any argument, df's and arrays are hashed from their values instead of being pickled
+def fingerprint(value, digest=None):
+    digest = digest or hashlib.blake2b(digest_size=16)
+
+    if isinstance(value, pd.DataFrame):
+        digest.update(b'df')
+        digest.update(repr((list(value.columns), [str(dtype) for dtype in value.dtypes])).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, pd.Series):
+        digest.update(b'series')
+        digest.update(repr((value.name, str(value.dtype))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.shape, str(value.dtype))).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(b'dict')
+        for key, item in value.items():
+            fingerprint(key, digest)
+            fingerprint(item, digest)
+    elif isinstance(value, pd.Index):
+        digest.update(b'index')
+        digest.update(repr((type(value).__name__, value.name, str(value.dtype), len(value))).encode())
+        digest.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+    elif isinstance(value, pd.api.extensions.ExtensionArray):
+        # Categoricals and other extension arrays have a shortened repr, so they are hashed from their values
+        digest.update(b'array')
+        digest.update(repr((type(value).__name__, str(value.dtype), len(value))).encode())
+        digest.update(pd.util.hash_array(np.asarray(value, dtype=object)).tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(type(value).__name__.encode())
+        for item in value:
+            fingerprint(item, digest)
+    elif value is None or isinstance(value, (str, bytes, bool, int, float, complex, np.generic, datetime.date, datetime.time, datetime.timedelta, pd.Period)):
+        digest.update(type(value).__name__.encode())
+        digest.update(repr(value).encode())
+    else:
+        # Anything else could have a repr that hides part of its value, so those calls are not cached
+        raise UnhashableArgument(type(value).__name__)
+
+    return digest
+
+# Rough size of a result in bytes so the cache can stay under its budget
+def result_size(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (dict, list, tuple)):
+        items = value.values() if isinstance(value, dict) else value
+        return sum(result_size(item) for item in items)
+    return len(pickle.dumps(value))
+
+# Least recently used cache with a byte budget and an optional on-disk tier
+class ResultCache:
+    def __init__(self, max_bytes=256 * 1024 ** 2, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f'{key}.pkl')
+
+    # Looks in memory first and then on disk, found is False when the key is not cached
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key][0]
+
+        if self.disk_dir is not None and os.path.exists(self._disk_path(key)):
+            with open(self._disk_path(key), 'rb') as f:
+                value = pickle.load(f)
+            self.disk_hits += 1
+            self._store_in_memory(key, value)
+            return True, value
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        self._store_in_memory(key, value)
+        if self.disk_dir is not None:
+            with open(self._disk_path(key), 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Adds to memory and drops the least recently used results until it fits the budget
+    def _store_in_memory(self, key, value):
+        size = result_size(value)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.current_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+
+    def clear(self, disk=False):
+        self.entries.clear()
+        self.current_bytes = 0
+        if disk and self.disk_dir is not None:
+            for file_name in os.listdir(self.disk_dir):
+                if file_name.endswith('.pkl'):
+                    os.remove(os.path.join(self.disk_dir, file_name))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'bytes': self.current_bytes
+        }
+
+# Turns caching on for every memoized function and gives back the cache so its stats can be checked
+def enable_cache(max_bytes=256 * 1024 ** 2, disk_dir=None):
+    global active_cache
+    active_cache = ResultCache(max_bytes, disk_dir)
+    return active_cache
+
+# Turns caching back off
+def disable_cache():
+    global active_cache
+    active_cache = None
+
+# Copies a cached result for the caller, df's and arrays use their own copy which is lazy under copy-on-write
+def copy_result(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return value.copy()
+    if isinstance(value, dict):
+        return {key: copy_result(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(copy_result(item) for item in value)
+    return copy.deepcopy(value)
+
+# Marks a function as safe to cache, it runs as normal unless enable_cache has been called
+def memoize(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = active_cache
+        if cache is None:
+            return func(*args, **kwargs)
+
+        # The key is taken before the call in case the function changes its inputs
+        # The dtype mode is part of the key since it changes the types of the results
+        try:
+            key = fingerprint((cache_version, library_version, func.__module__, func.__qualname__, get_dtype_policy()['mode'],
+                               args, sorted(kwargs.items()))).hexdigest()
+        except UnhashableArgument:
+            return func(*args, **kwargs)
+        found, value = cache.get(key)
+        if not found:
+            value = func(*args, **kwargs)
+            cache.put(key, value)
+
+        # A copy is handed back so changes made by the caller never reach the cached result
+        return copy_result(value)
+
+    return wrapper
@@ -1,20 +1,26 @@
 from datetime import date
+import json
 import pandas as pd
 import numpy as np
+from .caching import memoize
+from .dtypes import get_dtype_policy, apply_result_dtype
 
 '''
 Has any sort of math function that we are use relatively often. 
 '''
 
 # Creating function so that we calc the cumulative return of the entire df
+@memoize
 def compute_df_cumulative(df):
     return (1 + df.drop('date', axis=1)).cumprod() - 1
 
 # Function so that we calculate the cumulative return of a specific column
+@memoize
 def compute_col_cumulative(df, col):
     return (1 + df[col]).cumprod() - 1
 
 # Function so that we can calculate the annualized return
+@memoize
 def annualized_return(df, col, date1, date2):
     cumulative_return = compute_col_cumulative(df, col)
     # Dates need to be given in this form date(2023, 2, 15)
@@ -23,26 +29,118 @@ def annualized_return(df, col, date1, date2):
     
     return ((1 + cumulative_return) ** (365 / days)) - 1
 
-# Calculates the rolling returns a time period
-def compute_rolling_returns(df, time_period, return_periods, risk_free_rate):
-    returns_col = df.columns[1]
-
+# Gives back the number of return periods in a year based on the frequency of the data
+def periods_per_year(return_periods):
     if (return_periods == 'daily'):
-        num_returns = 252
-        rolling_count = time_period * 12
+        return 252
     elif (return_periods == 'weekly'):
-        num_returns = 52
-        rolling_count = time_period * 12
+        return 52
     elif (return_periods == 'monthly'):
-        num_returns = 12
+        return 12
+    elif (return_periods == 'quarterly'):
+        return 4
+    elif (return_periods == 'annual'):
+        return 1
+
+# Pandas period codes for each of the return frequencies
+period_codes = {'weekly': 'W', 'monthly': 'M', 'quarterly': 'Q', 'annual': 'Y'}
+
+# Finds the row where every period starts in a sorted array of dates, built once and shared by all columns
+def period_boundaries(dates, return_periods):
+    periods = pd.DatetimeIndex(dates).to_period(period_codes[return_periods]).asi8
+    return np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+
+# Compounds daily returns into weekly, monthly, quarterly or annual returns for every column of a wide df
+# Each period is dated on its last available day
+@memoize
+def resample_returns(df, return_periods):
+    if (return_periods == 'daily'):
+        return df
+
+    df = df.sort_values('date')
+    dates = pd.to_datetime(df['date']).to_numpy()
+    securities = [col for col in df.columns if col != 'date']
+    returns = df[securities].to_numpy(dtype='float64')
+
+    starts = period_boundaries(dates, return_periods)
+    ends = np.r_[starts[1:], len(dates)] - 1
+
+    # Compounds every period for all columns at once, a period with no data stays blank
+    observed = ~np.isnan(returns)
+    filled = np.where(observed, returns, 0.0)
+    period_counts = np.add.reduceat(observed, starts, axis=0)
+    if get_dtype_policy()['mode'] == 'precise':
+        # Precise mode multiplies the returns of each period out directly
+        period_growth = np.multiply.reduceat(1 + filled, starts, axis=0) - 1
+    else:
+        period_growth = np.expm1(np.add.reduceat(np.log1p(filled), starts, axis=0))
+    compounded = np.where(period_counts > 0, period_growth, np.nan)
+
+    resampled = pd.DataFrame(compounded, columns=securities)
+    resampled.insert(0, 'date', dates[ends])
+    return apply_result_dtype(resampled)
+
+# Compounds every window of a 2-D array of returns in one pass using cumulative log-returns
+def rolling_compound(values, window):
+    values = np.asarray(values, dtype='float64')
+    if values.ndim == 1:
+        values = values[:, None]
+
+    # Missing values are counted so any window that holds one comes back as NaN, like rolling().apply
+    missing = np.isnan(values)
+    # Returns of -100% or worse have no log-return, they are counted too and left out of the running sums
+    wiped_out = values <= -1
+    log_growth = np.log1p(np.where(missing | wiped_out, 0.0, values))
+
+    # Pads a row of zeros on top so the window sums are a single subtraction
+    zeros = np.zeros((1, values.shape[1]))
+    log_sums = np.vstack([zeros, np.cumsum(log_growth, axis=0)])
+    missing_counts = np.vstack([zeros, np.cumsum(missing, axis=0)])
+    wiped_out_counts = np.vstack([zeros, np.cumsum(wiped_out, axis=0)])
+
+    compounded = np.full(values.shape, np.nan)
+    if window <= values.shape[0] and get_dtype_policy()['mode'] == 'precise':
+        # Precise mode multiplies every window out directly, a chunk of windows at a time, to match np.prod exactly
+        windows = np.lib.stride_tricks.sliding_window_view(values, window, axis=0)
+        for start in range(0, len(windows), 1024):
+            block = windows[start:start + 1024]
+            compounded[window - 1 + start:window - 1 + start + len(block)] = np.prod(1 + block, axis=-1) - 1
+    elif window <= values.shape[0]:
+        window_sums = log_sums[window:] - log_sums[:-window]
+        window_missing = missing_counts[window:] - missing_counts[:-window]
+        compounded[window - 1:] = np.where(window_missing > 0, np.nan, np.expm1(window_sums))
+
+        # Only the windows that hold a return of -100% or worse are multiplied out directly
+        window_wiped_out = wiped_out_counts[window:] - wiped_out_counts[:-window]
+        rows, cols = np.nonzero((window_wiped_out > 0) & (window_missing == 0))
+        if len(rows):
+            windows = np.lib.stride_tricks.sliding_window_view(values, window, axis=0)
+            compounded[window - 1 + rows, cols] = np.prod(1 + windows[rows, cols], axis=-1) - 1
+
+    return compounded
+
+# Rolling return df's for every column of a wide df in one pass, shared by the single and wide versions below
+def rolling_return_frames(df, time_period, return_periods, risk_free_rate, resample=False):
+    # Daily data can be compounded into the return_periods frequency first
+    if resample:
+        df = resample_returns(df, return_periods)
+
+    returns_cols = [col for col in df.columns if col != 'date']
+
+    num_returns = periods_per_year(return_periods)
+    # Resampled data has one row per period, so the window holds time_period years of those periods
+    if resample and return_periods != 'daily':
+        rolling_count = time_period * periods_per_year(return_periods)
+    else:
         rolling_count = time_period * 12
 
     df = df.copy()
     df.set_index('date', inplace=True)
 
-    returns = df[returns_col]
-    # Total rolling returns
-    rolling_total = (1 + returns).rolling(rolling_count).apply(np.prod, raw=True) - 1
+    returns = df[returns_cols].astype('float64')
+    # Total rolling returns, this is also the rolling cumulative return so it is only computed once
+    rolling_total = pd.DataFrame(rolling_compound(returns.to_numpy(), rolling_count),
+                                 index=returns.index, columns=returns_cols)
 
     # Annualized return calculation
     rolling_annualized = (1 + rolling_total) ** (num_returns / rolling_count) - 1
@@ -53,36 +151,50 @@ def compute_rolling_returns(df, time_period, return_periods, risk_free_rate):
     # Cumulative return calculation
     cumulative_return = (1 + returns).cumprod() - 1
 
-    # Rolling cumulative return 
-    rolling_cumulative_return = (1 + returns).rolling(rolling_count).apply(np.prod, raw=True) - 1
-
     # Rolling Sharpe Ratio
     rolling_sharpe = (rolling_annualized - risk_free_rate) / rolling_volatility
-    
+
     # Returns the values in a dataframe format for simple plotting and use
-    return pd.DataFrame({
-        'cumulative_return': cumulative_return,
-        'rolling_cumulative_return': rolling_cumulative_return,
-        'annualized_return': rolling_annualized,
-        'rolling_volatility': rolling_volatility,
-        'rolling_sharpe': rolling_sharpe
-        
-    }).reset_index()
-
-def compute_returns(df, return_periods, risk_free_rate):
+    results = {}
+    for col in returns_cols:
+        results[col] = apply_result_dtype(pd.DataFrame({
+            'cumulative_return': cumulative_return[col],
+            'rolling_cumulative_return': rolling_total[col],
+            'annualized_return': rolling_annualized[col],
+            'rolling_volatility': rolling_volatility[col],
+            'rolling_sharpe': rolling_sharpe[col]
+        }).reset_index())
+
+    return results
+
+# Calculates the rolling returns a time period for the returns column of a [date, returns] df
+@memoize
+def compute_rolling_returns(df, time_period, return_periods, risk_free_rate, resample=False):
+    returns_col = df.columns[1]
+    return rolling_return_frames(df[['date', returns_col]], time_period, return_periods, risk_free_rate, resample)[returns_col]
+
+# Calculates the rolling returns for every security in a wide df at once, gives a dictionary keyed by security
+@memoize
+def compute_panel_rolling_returns(df, time_period, return_periods, risk_free_rate, resample=False):
+    return rolling_return_frames(df, time_period, return_periods, risk_free_rate, resample)
+
+@memoize
+def compute_returns(df, return_periods, risk_free_rate, resample=False):
     df = pd.DataFrame(df)
+    # Daily data can be compounded into the return_periods frequency first
+    if resample:
+        df = resample_returns(df, return_periods)
+
     returns_col = df.columns[1]
     
     df = df.copy()
     df.set_index('date', inplace=True)
     returns = df[returns_col]
+    # Precise mode never compounds in float32, even when data_prep gave float32 values
+    if get_dtype_policy()['mode'] == 'precise':
+        returns = returns.astype('float64')
 
-    if (return_periods == 'daily'):
-        num_returns = 252
-    elif (return_periods == 'weekly'):
-        num_returns = 52
-    elif (return_periods == 'monthly'):
-        num_returns = 12
+    num_returns = periods_per_year(return_periods)
 
     # Total cumulative return
     cumulative_return = (1 + returns).cumprod() - 1
@@ -98,17 +210,614 @@ def compute_returns(df, return_periods, risk_free_rate):
     # Sharpe ratio
     sharpe_ratio = (annualized_return - risk_free_rate) / volatility
 
-    return pd.DataFrame({
+    # Scalars are broadcast by pandas so there is no need to build full length lists
+    return apply_result_dtype(pd.DataFrame({
         'cumulative_return': cumulative_return,
-        'annualized_return': [annualized_return] * len(returns),
-        'volatility': [volatility] * len(returns),
-        'sharpe_ratio': [sharpe_ratio] * len(returns)
-    })
+        'annualized_return': annualized_return,
+        'volatility': volatility,
+        'sharpe_ratio': sharpe_ratio
+    }))
+
+# Calculates the full period return metrics for every security in a wide df, one row per security
+@memoize
+def compute_panel_returns(df, return_periods, risk_free_rate, include_paths=False, resample=False):
+    # Daily data can be compounded into the return_periods frequency first
+    if resample:
+        df = resample_returns(df, return_periods)
+
+    df = df.copy()
+    df.set_index('date', inplace=True)
+    securities = df.columns
+
+    returns = df.to_numpy(dtype='float64')
+    num_returns = periods_per_year(return_periods)
+
+    # Cumulative return paths for all securities at once, missing days carry the last value forward
+    growth = np.nancumprod(1 + returns, axis=0)
+    cumulative_paths = np.where(np.isnan(returns), np.nan, growth - 1)
+    total_return = growth[-1] - 1
+
+    # Each security is annualized over the number of returns it actually has
+    n_days = np.sum(~np.isnan(returns), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        annualized = (1 + total_return) ** (num_returns / n_days) - 1
+        volatility = np.nanstd(returns, axis=0, ddof=1) * np.sqrt(num_returns)
+        sharpe_ratio = (annualized - risk_free_rate) / volatility
+
+    summary = pd.DataFrame({
+        'cumulative_return': total_return,
+        'annualized_return': annualized,
+        'volatility': volatility,
+        'sharpe_ratio': sharpe_ratio
+    }, index=pd.Index(securities, name='security'))
+
+    summary = apply_result_dtype(summary)
+    if include_paths:
+        paths = pd.DataFrame(cumulative_paths, index=df.index, columns=securities).reset_index()
+        return summary, apply_result_dtype(paths)
+    return summary
+
+# Historical VaR and CVaR along the last axis using a partial sort instead of a full sort
+# VaR is the return at the lower tail quantile and CVaR is the average return at or below it
+def tail_risk(values, confidence=0.95):
+    values = np.asarray(values, dtype='float64')
+    counts = np.sum(~np.isnan(values), axis=-1)
+    # Missing values are pushed to the top so they never land in the tail
+    values = np.where(np.isnan(values), np.inf, values)
+
+    k = np.floor((1 - confidence) * np.maximum(counts - 1, 0)).astype(int)
+    partitioned = np.partition(values, np.unique(k), axis=-1)
+
+    var = np.take_along_axis(partitioned, k[..., None], axis=-1)[..., 0]
+    in_tail = np.arange(values.shape[-1]) <= k[..., None]
+    cvar = np.sum(np.where(in_tail, partitioned, 0.0), axis=-1) / (k + 1)
+
+    empty = counts == 0
+    return np.where(empty, np.nan, var), np.where(empty, np.nan, cvar)
+
+# Max drawdown and the longest stretch below a prior peak, along axis 0 of a 2-D array of returns
+def drawdown_stats(values):
+    values = np.asarray(values, dtype='float64')
+    # Starts every path at 1 so a loss on the first day counts as a drawdown
+    growth = np.vstack([np.ones((1, values.shape[1])), np.nancumprod(1 + values, axis=0)])
+    peaks = np.maximum.accumulate(growth, axis=0)
+    drawdowns = growth / peaks - 1
+
+    # Counts the rows since the last time each security was at its peak
+    rows = np.arange(len(growth))[:, None]
+    last_peak = np.maximum.accumulate(np.where(drawdowns < 0, 0, rows), axis=0)
+    durations = rows - last_peak
+
+    return drawdowns.min(axis=0), durations.max(axis=0)
+
+# Calculates drawdown, downside deviation, Sortino and historical VaR/CVaR for every column of a wide returns df
+# Gives one row per security over the full period, or a dictionary of rolling results keyed by security when window is given
+@memoize
+def compute_risk_metrics(df, return_periods, risk_free_rate, confidence=0.95, window=None, chunk_size=256):
+    df = df.sort_values('date')
+    securities = [col for col in df.columns if col != 'date']
+    returns = df[securities].to_numpy(dtype='float64')
+    num_returns = periods_per_year(return_periods)
+    # Returns below the risk free rate for a single period count as downside
+    target = risk_free_rate / num_returns
+
+    if window is None:
+        n_days = np.sum(~np.isnan(returns), axis=0)
+        total_return = np.nancumprod(1 + returns, axis=0)[-1] - 1
+        max_drawdown, drawdown_duration = drawdown_stats(returns)
+        shortfall = np.minimum(returns - target, 0.0)
+        var, cvar = tail_risk(returns.T, confidence)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            annualized = (1 + total_return) ** (num_returns / n_days) - 1
+            downside_deviation = np.sqrt(np.nansum(shortfall ** 2, axis=0) / n_days) * np.sqrt(num_returns)
+            sortino_ratio = (annualized - risk_free_rate) / downside_deviation
+
+        return apply_result_dtype(pd.DataFrame({
+            'max_drawdown': max_drawdown,
+            'max_drawdown_duration': drawdown_duration,
+            'downside_deviation': downside_deviation,
+            'sortino_ratio': sortino_ratio,
+            'var': var,
+            'cvar': cvar
+        }, index=pd.Index(securities, name='security')))
+
+    n_dates = len(returns)
+    names = ['rolling_max_drawdown', 'rolling_max_drawdown_duration', 'rolling_downside_deviation', 'rolling_sortino', 'rolling_var', 'rolling_cvar']
+    rolling = {name: np.full((n_dates, len(securities)), np.nan) for name in names}
+
+    if window <= n_dates:
+        # Every window is a view of the returns with shape (windows, securities, window)
+        windows = np.lib.stride_tricks.sliding_window_view(returns, window, axis=0)
+
+        # The windows are worked through in chunks so memory stays bounded by chunk_size
+        for start in range(0, len(windows), chunk_size):
+            block = windows[start:start + chunk_size]
+            rows = slice(window - 1 + start, window - 1 + start + len(block))
+            complete = ~np.isnan(block).any(axis=-1)
+
+            growth = np.cumprod(1 + block, axis=-1)
+            peaks = np.maximum(np.maximum.accumulate(growth, axis=-1), 1.0)
+            drawdowns = growth / peaks - 1
+            max_drawdown = drawdowns.min(axis=-1)
+
+            # Rows since each window was last at its peak, counted the same way as drawdown_stats
+            steps = np.arange(1, window + 1)
+            last_peak = np.maximum.accumulate(np.where(drawdowns < 0, 0, steps), axis=-1)
+            drawdown_duration = (steps - last_peak).max(axis=-1)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                annualized = growth[..., -1] ** (num_returns / window) - 1
+                downside_deviation = np.sqrt(np.mean(np.minimum(block - target, 0.0) ** 2, axis=-1)) * np.sqrt(num_returns)
+                sortino = (annualized - risk_free_rate) / downside_deviation
+            var, cvar = tail_risk(block, confidence)
+
+            for name, values in zip(names, [max_drawdown, drawdown_duration, downside_deviation, sortino, var, cvar]):
+                rolling[name][rows] = np.where(complete, values, np.nan)
+
+    results = {}
+    for i, security in enumerate(securities):
+        result = pd.DataFrame({name: values[:, i] for name, values in rolling.items()})
+        result.insert(0, 'date', df['date'].to_numpy())
+        results[security] = result
+
+    return apply_result_dtype(results)
+
+# Calculates the ΔDay, ΔWTD, ΔMTD, ΔQTD, ΔYTD, Δ1Yr, Δ3Yr and Δ5Yr compounded returns for every security
+# The output has one row per security and works with convert_deltas_to_percent and plot_styled_table
+@memoize
+def compute_trailing_returns(df, as_of=None):
+    df = df.sort_values('date')
+    dates = pd.to_datetime(df['date']).to_numpy()
+    securities = [col for col in df.columns if col != 'date']
+    returns = df[securities].to_numpy(dtype='float64')
+
+    # Missing days count as no change
+    filled = np.nan_to_num(returns)
+
+    as_of = pd.Timestamp(dates[-1]) if as_of is None else pd.Timestamp(as_of)
+    end = np.searchsorted(dates, as_of.to_datetime64(), side='right')
+    day = as_of.normalize()
+
+    # The calendar periods start on their first day, the trailing years start just after the same day years back
+    period_starts = {
+        'ΔWTD': day - pd.Timedelta(days=day.weekday()),
+        'ΔMTD': day.replace(day=1),
+        'ΔQTD': pd.Timestamp(year=day.year, month=3 * (day.quarter - 1) + 1, day=1),
+        'ΔYTD': day.replace(month=1, day=1),
+        'Δ1Yr': as_of - pd.DateOffset(years=1),
+        'Δ3Yr': as_of - pd.DateOffset(years=3),
+        'Δ5Yr': as_of - pd.DateOffset(years=5)
+    }
+    boundaries = np.array([start.to_datetime64() for start in period_starts.values()]).astype(dates.dtype)
+    trailing_years = np.array(['Yr' in label for label in period_starts])
+    # One binary search each way over the sorted dates finds where every period begins
+    starts = np.where(trailing_years, np.searchsorted(dates, boundaries, side='right'), np.searchsorted(dates, boundaries, side='left'))
+
+    # There are only eight periods, so each one is multiplied out directly, which also handles returns of -100%
+    table = {'ΔDay': np.prod(1 + filled[max(end - 1, 0):end], axis=0) - 1}
+    for (label, start_date), start in zip(period_starts.items(), starts):
+        trailing = np.prod(1 + filled[start:end], axis=0) - 1
+        # The trailing years are left blank when the history does not go back far enough
+        if label.endswith('Yr') and start_date < pd.Timestamp(dates[0]):
+            trailing = np.full(len(securities), np.nan)
+        table[label] = trailing
+
+    return apply_result_dtype(pd.DataFrame(table, index=pd.Index(securities, name='security')).reset_index())
 
 # Calculates the z-score for a specified column
+@memoize
 def z_score(df, col):
     return (df[col].iloc[-1] - df[col].mean()) / df[col].std()
 
+# Builds the z-score, mean and +/-1 and 2 standard deviation bands for every date and security
+# Uses an expanding window by default, or a rolling window of that many rows when window is given
+@memoize
+def z_score_bands(df, col, window=None):
+    df = df.sort_values(['security', 'date'], kind='stable')
+    grouped = df[col].astype('float64').groupby(df['security'], sort=False, observed=True)
+
+    if window is None:
+        windows = grouped.expanding()
+    else:
+        windows = grouped.rolling(window)
+
+    # Drops the security level so the results line back up with the rows of the df
+    mean = windows.mean().droplevel(0)
+    std = windows.std().droplevel(0)
+
+    bands = df.copy()
+    bands['mean'] = mean
+    bands['std'] = std
+    bands['z_score'] = (bands[col] - mean) / std
+    bands['plus_1_std'] = mean + std
+    bands['minus_1_std'] = mean - std
+    bands['plus_2_std'] = mean + 2 * std
+    bands['minus_2_std'] = mean - 2 * std
+
+    # Gives a dictionary keyed by security so it can be used as prepared_dataframes when plotting
+    return apply_result_dtype({security: group for security, group in bands.groupby('security', sort=False, observed=True)})
+
+# Sorted history of one security's values so percentile ranks can be looked up with a binary search
+class PercentileIndex:
+    def __init__(self, values, merge_size=256):
+        values = np.asarray(values, dtype='float64')
+        self.sorted_values = np.sort(values[~np.isnan(values)])
+        # New values wait in a small sorted buffer and are merged in once it fills up
+        self.pending = np.empty(0)
+        self.merge_size = merge_size
+
+    # Builds an index from a prepared df, such as the output of data_prep
+    @classmethod
+    def from_df(cls, df, col, merge_size=256):
+        return cls(df[col].to_numpy(), merge_size)
+
+    def __len__(self):
+        return len(self.sorted_values) + len(self.pending)
+
+    # Adds new values without sorting the full history again
+    def append(self, values):
+        values = np.atleast_1d(np.asarray(values, dtype='float64'))
+        values = values[~np.isnan(values)]
+        self.pending = np.sort(np.concatenate([self.pending, values]))
+
+        if len(self.pending) >= self.merge_size:
+            self._merge()
+
+    # Places the buffered values into the sorted history at their binary search positions
+    def _merge(self):
+        positions = np.searchsorted(self.sorted_values, self.pending)
+        self.sorted_values = np.insert(self.sorted_values, positions, self.pending)
+        self.pending = np.empty(0)
+
+    # Counts the values below and equal to each query value in O(log n)
+    def _counts(self, values):
+        values = np.asarray(values, dtype='float64')
+        below = np.searchsorted(self.sorted_values, values, side='left') + np.searchsorted(self.pending, values, side='left')
+        at_or_below = np.searchsorted(self.sorted_values, values, side='right') + np.searchsorted(self.pending, values, side='right')
+        return below, at_or_below - below
+
+    # Percentile rank between 0 and 1, values in the history match rank(pct=True) from pandas
+    def percentile(self, values):
+        below, equal = self._counts(values)
+        return np.where(equal > 0, below + (equal + 1) / 2, below) / len(self)
+
+    # Gives back the value at the given percentiles of the history
+    def quantile(self, q):
+        if len(self.pending):
+            self._merge()
+        return np.quantile(self.sorted_values, q)
+
+# Builds a percentile index for each security in a dictionary of prepared df's
+def build_percentile_indexes(prepared_dfs, col, merge_size=256):
+    return {security: PercentileIndex.from_df(df, col, merge_size) for security, df in prepared_dfs.items()}
+
+# Adds the percentile rank of each value within its own history for every date and security
+# Uses an expanding window by default, or a rolling window of that many rows when window is given
+@memoize
+def rolling_percentile(df, col, window=None):
+    df = df.sort_values(['security', 'date'], kind='stable')
+    grouped = df[col].astype('float64').groupby(df['security'], sort=False, observed=True)
+
+    if window is None:
+        windows = grouped.expanding()
+    else:
+        windows = grouped.rolling(window)
+
+    ranked = df.copy()
+    ranked['percentile'] = windows.rank(method='average', pct=True).droplevel(0)
+
+    # Gives a dictionary keyed by security so it can be used as prepared_dataframes when plotting
+    return apply_result_dtype({security: group for security, group in ranked.groupby('security', sort=False, observed=True)})
+
+# Keeps running return statistics so a new day of returns can be added without recomputing the history
+class ReturnsAccumulator:
+    def __init__(self, securities, return_periods, risk_free_rate, time_period=None):
+        self.securities = list(securities)
+        self.return_periods = return_periods
+        self.risk_free_rate = risk_free_rate
+        self.time_period = time_period
+        self.last_date = None
+
+        n = len(self.securities)
+        # Full period state, a running product for cumulative return and Welford mean/variance
+        self.growth = np.ones(n)
+        self.count = np.zeros(n)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.last_value = np.full(n, np.nan)
+
+        # Rolling state, a ring buffer holding the window plus running sums over it
+        self.window = time_period * 12 if time_period is not None else None
+        if self.window is not None:
+            self.buffer = np.full((self.window, n), np.nan)
+            self.position = 0
+            self._refresh_window()
+
+    # Recomputes the window sums straight from the ring buffer so rounding errors never build up
+    def _refresh_window(self):
+        missing = np.isnan(self.buffer)
+        values = np.where(missing, 0.0, self.buffer)
+        self.window_missing = missing.sum(axis=0)
+        self.window_log_sum = np.log1p(values).sum(axis=0)
+        self.window_sum = values.sum(axis=0)
+        self.window_sum_sq = (values ** 2).sum(axis=0)
+
+    # Adds one row of returns, missing values are skipped for that security
+    def append(self, date, values):
+        if isinstance(values, dict):
+            values = [values.get(security, np.nan) for security in self.securities]
+        values = np.asarray(values, dtype='float64')
+        observed = ~np.isnan(values)
+        filled = np.where(observed, values, 0.0)
+
+        # Full period updates
+        self.growth = np.where(observed, self.growth * (1 + filled), self.growth)
+        self.count = self.count + observed
+        delta = np.where(observed, filled - self.mean, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.mean = self.mean + np.where(observed, delta / self.count, 0.0)
+        self.m2 = self.m2 + np.where(observed, delta * (filled - self.mean), 0.0)
+        self.last_value = values
+        self.last_date = date
+
+        # Rolling updates swap the oldest value in the window for the newest one
+        if self.window is not None:
+            old = self.buffer[self.position]
+            old_missing = np.isnan(old)
+            old_filled = np.where(old_missing, 0.0, old)
+
+            self.buffer[self.position] = values
+            self.window_missing = self.window_missing - old_missing + ~observed
+            self.window_log_sum = self.window_log_sum - np.log1p(old_filled) + np.log1p(filled)
+            self.window_sum = self.window_sum - old_filled + filled
+            self.window_sum_sq = self.window_sum_sq - old_filled ** 2 + filled ** 2
+
+            self.position = (self.position + 1) % self.window
+            if self.position == 0:
+                self._refresh_window()
+
+    # Adds every row of a wide returns df in date order
+    def extend(self, df):
+        for row in df[['date'] + self.securities].itertuples(index=False):
+            self.append(row[0], row[1:])
+        return self
+
+    # Full period metrics in the same layout as compute_panel_returns
+    def results(self):
+        num_returns = periods_per_year(self.return_periods)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            annualized = self.growth ** (num_returns / self.count) - 1
+            volatility = np.sqrt(self.m2 / (self.count - 1)) * np.sqrt(num_returns)
+            sharpe_ratio = (annualized - self.risk_free_rate) / volatility
+
+        return apply_result_dtype(pd.DataFrame({
+            'cumulative_return': self.growth - 1,
+            'annualized_return': annualized,
+            'volatility': volatility,
+            'sharpe_ratio': sharpe_ratio
+        }, index=pd.Index(self.securities, name='security')))
+
+    # Latest rolling metrics, these match the last row of compute_rolling_returns
+    def rolling_results(self):
+        if self.window is None:
+            raise ValueError("A time_period is needed to calculate rolling results")
+
+        num_returns = periods_per_year(self.return_periods)
+        full = self.window_missing == 0
+
+        rolling_total = np.where(full, np.expm1(self.window_log_sum), np.nan)
+        rolling_annualized = (1 + rolling_total) ** (num_returns / self.window) - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = (self.window_sum_sq - self.window_sum ** 2 / self.window) / (self.window - 1)
+            rolling_volatility = np.where(full, np.sqrt(np.maximum(variance, 0.0)), np.nan) * np.sqrt(num_returns)
+            rolling_sharpe = (rolling_annualized - self.risk_free_rate) / rolling_volatility
+
+        return apply_result_dtype(pd.DataFrame({
+            'cumulative_return': self.growth - 1,
+            'rolling_cumulative_return': rolling_total,
+            'annualized_return': rolling_annualized,
+            'rolling_volatility': rolling_volatility,
+            'rolling_sharpe': rolling_sharpe
+        }, index=pd.Index(self.securities, name='security')))
+
+    # Z-score of the latest value against the full history, the same as z_score on each column
+    def z_scores(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(self.m2 / (self.count - 1))
+            return pd.Series((self.last_value - self.mean) / std, index=self.securities, name='z-score')
+
+    # Saves the state off as plain lists so it can be written to json and picked back up later
+    def to_dict(self):
+        state = {
+            'securities': self.securities,
+            'return_periods': self.return_periods,
+            'risk_free_rate': self.risk_free_rate,
+            'time_period': self.time_period,
+            'last_date': None if self.last_date is None else str(self.last_date),
+            'growth': self.growth.tolist(),
+            'count': self.count.tolist(),
+            'mean': self.mean.tolist(),
+            'm2': self.m2.tolist(),
+            'last_value': self.last_value.tolist()
+        }
+        if self.window is not None:
+            state['buffer'] = self.buffer.tolist()
+            state['position'] = self.position
+        return state
+
+    # Rebuilds an accumulator from the output of to_dict
+    @classmethod
+    def from_dict(cls, state):
+        accumulator = cls(state['securities'], state['return_periods'], state['risk_free_rate'], state['time_period'])
+        accumulator.last_date = state['last_date']
+        accumulator.growth = np.array(state['growth'], dtype='float64')
+        accumulator.count = np.array(state['count'], dtype='float64')
+        accumulator.mean = np.array(state['mean'], dtype='float64')
+        accumulator.m2 = np.array(state['m2'], dtype='float64')
+        accumulator.last_value = np.array(state['last_value'], dtype='float64')
+        if accumulator.window is not None:
+            accumulator.buffer = np.array(state['buffer'], dtype='float64').reshape(accumulator.window, -1)
+            accumulator.position = state['position']
+            accumulator._refresh_window()
+        return accumulator
+
+    # Writes the state to a json file
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    # Loads the state from a json file made by save
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+# Rolling covariance and correlation matrices for every pair of columns, shape (dates, securities, securities)
+# Everything comes from shared rolling sums of x and xy so no pair is computed on its own
+# The xy sums are built a chunk of dates at a time, so only the two outputs are ever full size
+def rolling_covariance_tensor(values, window, chunk_bytes=64 * 1024 ** 2):
+    values = np.asarray(values, dtype='float64')
+    n_dates, n_securities = values.shape
+
+    # Centering on the column means keeps the sums small so the differences stay accurate
+    missing = np.isnan(values)
+    centered = np.where(missing, 0.0, values - np.nanmean(values, axis=0))
+
+    covariance = np.full((n_dates, n_securities, n_securities), np.nan)
+    correlation = np.full((n_dates, n_securities, n_securities), np.nan)
+    if window > n_dates:
+        return covariance, correlation
+
+    zeros = np.zeros((1, n_securities))
+    sums = np.vstack([zeros, np.cumsum(centered, axis=0)])
+    missing_counts = np.vstack([zeros, np.cumsum(missing, axis=0)])
+    window_sums = sums[window:] - sums[:-window]
+    # A pair is blank whenever either security has a missing value in the window
+    complete = (missing_counts[window:] - missing_counts[:-window]) == 0
+
+    n_windows = n_dates - window + 1
+    chunk_size = max(1, chunk_bytes // (8 * n_securities ** 2))
+    for start in range(0, n_windows, chunk_size):
+        stop = min(start + chunk_size, n_windows)
+
+        # The first window of the chunk is summed directly so rounding errors never carry over between chunks,
+        # then each later window adds its newest row and drops its oldest one
+        first = centered[start:start + window]
+        steps = (np.einsum('ti,tj->tij', centered[start + window:stop + window - 1], centered[start + window:stop + window - 1])
+                 - np.einsum('ti,tj->tij', centered[start:stop - 1], centered[start:stop - 1]))
+        window_cross = np.concatenate([(first.T @ first)[None], first.T @ first + np.cumsum(steps, axis=0)])
+
+        chunk_sums = window_sums[start:stop]
+        chunk_complete = complete[start:stop]
+        cov = (window_cross - chunk_sums[:, :, None] * chunk_sums[:, None, :] / window) / (window - 1)
+        cov[~(chunk_complete[:, :, None] & chunk_complete[:, None, :])] = np.nan
+
+        std = np.sqrt(np.maximum(np.diagonal(cov, axis1=1, axis2=2), 0.0))
+        rows = slice(window - 1 + start, window - 1 + stop)
+        covariance[rows] = cov
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(cov, std[:, :, None] * std[:, None, :], out=correlation[rows])
+
+    return covariance, correlation
+
+# Rolling correlations for a wide returns df, gives a dictionary keyed by security for the plotting functions
+# Each df has the rolling correlation to every other security, plus the covariance and beta against the benchmark when given
+@memoize
+def rolling_correlation(df, window, benchmark=None):
+    df = df.sort_values('date')
+    securities = [col for col in df.columns if col != 'date']
+    covariance, correlation = rolling_covariance_tensor(df[securities].to_numpy(), window)
+
+    if benchmark is not None:
+        b = securities.index(benchmark)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = covariance[:, :, b] / covariance[:, b, b][:, None]
+
+    results = {}
+    for i, security in enumerate(securities):
+        result = pd.DataFrame(correlation[:, i, :], columns=securities)
+        result.insert(0, 'date', df['date'].to_numpy())
+        if benchmark is not None:
+            result['covariance'] = covariance[:, i, b]
+            result['beta'] = beta[:, i]
+        results[security] = result
+
+    return apply_result_dtype(results)
+
+# Keeps the rolling sums for the latest window so a new row updates the covariance, correlation and beta matrices
+class RollingCovariance:
+    def __init__(self, securities, window):
+        self.securities = list(securities)
+        self.window = window
+        self.last_date = None
+
+        n = len(self.securities)
+        self.buffer = np.full((window, n), np.nan)
+        self.position = 0
+        self._refresh()
+
+    # Recomputes the sums straight from the ring buffer so rounding errors never build up
+    def _refresh(self):
+        missing = np.isnan(self.buffer)
+        values = np.where(missing, 0.0, self.buffer)
+        self.window_missing = missing.sum(axis=0)
+        self.window_sum = values.sum(axis=0)
+        self.window_cross = values.T @ values
+
+    # Fills the window from the last rows of a wide returns df
+    @classmethod
+    def from_df(cls, df, window):
+        securities = [col for col in df.columns if col != 'date']
+        rolling = cls(securities, window)
+        tail = df.sort_values('date').tail(window)
+        # An empty df gives back an empty window, ready for append
+        if len(tail) == 0:
+            return rolling
+        rolling.buffer[-len(tail):] = tail[securities].to_numpy(dtype='float64')
+        rolling.position = 0
+        rolling.last_date = tail['date'].iloc[-1]
+        rolling._refresh()
+        return rolling
+
+    # Adds one row of returns and drops the oldest one in O(securities squared)
+    def append(self, date, values):
+        if isinstance(values, dict):
+            values = [values.get(security, np.nan) for security in self.securities]
+        values = np.asarray(values, dtype='float64')
+        old = self.buffer[self.position]
+
+        new_filled = np.where(np.isnan(values), 0.0, values)
+        old_filled = np.where(np.isnan(old), 0.0, old)
+        self.window_missing = self.window_missing - np.isnan(old) + np.isnan(values)
+        self.window_sum = self.window_sum - old_filled + new_filled
+        self.window_cross = self.window_cross - np.outer(old_filled, old_filled) + np.outer(new_filled, new_filled)
+
+        self.buffer[self.position] = values
+        self.last_date = date
+        self.position = (self.position + 1) % self.window
+        if self.position == 0:
+            self._refresh()
+
+    def covariance(self):
+        cov = (self.window_cross - np.outer(self.window_sum, self.window_sum) / self.window) / (self.window - 1)
+        complete = self.window_missing == 0
+        cov = np.where(np.outer(complete, complete), cov, np.nan)
+        return pd.DataFrame(cov, index=self.securities, columns=self.securities)
+
+    def correlation(self):
+        cov = self.covariance()
+        std = np.sqrt(np.maximum(np.diag(cov.to_numpy()), 0.0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return cov / np.outer(std, std)
+
+    # Beta of every security against the benchmark over the latest window
+    def beta(self, benchmark):
+        cov = self.covariance()
+        return (cov[benchmark] / cov.loc[benchmark, benchmark]).rename('beta')
+
 
 ### These are mainly used when we want to adjust for plotting
 
@@ -1,6 +1,16 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import functools
+from collections.abc import MutableMapping
 import pandas as pd
+import numpy as np
 import random
-from .calcs import z_score, annualized_return, compute_col_cumulative
+from .caching import memoize
+from .dtypes import get_dtype_policy, dtype_policy, policies, apply_result_dtype
+from .calcs import period_codes, compute_rolling_returns, compute_panel_rolling_returns
 
 '''
 Complete data preperation including adding the quarter_year column, creating the z_scores, and selecting only single indexs in their own df's
@@ -18,31 +28,63 @@ def data_info(df):
     print("The data types of each column: ")
     print(df.dtypes, "\n")
 
+# Acts like a dictionary of [date, column] df's for a wide df, each df is only built the first time it is used
+# Every df shares the same converted date array and the given df is never changed
+class ColumnFrames(MutableMapping):
+    def __init__(self, df, date, value_name=None, date_name=None):
+        self.source = df
+        self.keys_list = [col for col in df.columns if col != date]
+        # The dates are converted a single time and shared by every df
+        self.dates = pd.to_datetime(df[date])
+        self.date_name = date if date_name is None else date_name
+        self.value_name = value_name
+        self.built = {}
+
+    def __len__(self):
+        return len(self.keys_list)
+
+    def __iter__(self):
+        return iter(self.keys_list)
+
+    def __contains__(self, col):
+        return col in self.built or col in self.keys_list
+
+    def __getitem__(self, col):
+        if col not in self.built:
+            if col not in self.keys_list:
+                raise KeyError(col)
+            name = col if self.value_name is None else self.value_name
+            values = self.source[col]
+            # Compact and precise modes set the value type, standard keeps the type from the df
+            split_dtype = get_dtype_policy()['split_dtype']
+            if split_dtype is not None and values.dtype.kind in 'iuf':
+                values = values.astype(split_dtype, copy=False)
+            # Built from the Series so copy-on-write only copies a column once the df is written to
+            self.built[col] = pd.DataFrame({self.date_name: self.dates, name: values}, copy=False)
+        return self.built[col]
+
+    # Allows for replacing or adding df's the same way as a normal dictionary
+    def __setitem__(self, col, df):
+        if col not in self.keys_list:
+            self.keys_list.append(col)
+        self.built[col] = df
+
+    def __delitem__(self, col):
+        if col not in self.keys_list:
+            raise KeyError(col)
+        self.keys_list.remove(col)
+        self.built.pop(col, None)
+
+    def __repr__(self):
+        return f'ColumnFrames({self.keys_list})'
+
 # Splits a data with indexes as headers into seperate dfs
 def split_columns_to_dfs(df, date):
-    df[date] = pd.to_datetime(df[date])
-    df = df.copy()
-    
-    dfs = {}
-    for col in df.columns:
-        if col != date:
-            dfs[col] = df[[date, col]].copy()
-    
-    return dfs
+    return ColumnFrames(df, date)
 
 # Splits a data with indexes as headers into seperate dfs
 def split_returns_cols(df, date):
-    df[date] = pd.to_datetime(df[date])
-    df = df.copy()
-    
-    dfs = {}
-    for col in df.columns:
-        if col != date:
-            temp_df = df[[date, col]].copy()
-            temp_df.columns = ['date', 'value']
-            dfs[col] = temp_df
-    
-    return dfs
+    return ColumnFrames(df, date, value_name='value', date_name='date')
 
 # Allows you to get a list of unique values for a specific column
 def unique_values(df, column, number=None):
@@ -130,153 +172,745 @@ def generate_palette(style="vibrant rich", n=5):
     return [rgb_to_hex(apply_tag_modifiers(tags)) for _ in range(n)]
 
 
-# Adds a column that has the quarter and year combined
-def data_prep(df, security, col):
-    # Ensures the values are correct and smaller forms for better runtimes
+# Converts the dates and values and adds the year, quarter and quarter_year columns without changing the given df
+def normalize_long(df, col):
+    policy = get_dtype_policy()
+    df = df.copy()
+    # Ensures the values are correct and smaller forms for better runtimes, the dtype mode picks the size
     df['date'] = pd.to_datetime(df['date'])
-    df[col] = df[col].astype('float32')
+    df[col] = df[col].astype(policy['value_dtype'])
+    # Compact and precise modes also set the type of the other float columns, like BEST_PE_RATIO next to PE_RATIO
+    if policy['other_value_dtype'] is not None:
+        other_cols = [other for other in df.columns if other != col and pd.api.types.is_float_dtype(df[other])]
+        df = df.astype({other: policy['other_value_dtype'] for other in other_cols})
+    if policy['labels'] == 'category':
+        df['security'] = df['security'].astype('category')
+
+    df['year'], df['quarter'], df['quarter_year'] = quarter_labels(df['date'])
+
+    return df
+
+# Builds the year, quarter and quarter_year text for a set of dates
+def quarter_labels(dates):
+    # Only the unique quarters get turned into text, every date then looks up its label
+    dates = pd.DatetimeIndex(dates)
+    period_keys = dates.year.to_numpy() * 4 + dates.quarter.to_numpy() - 1
+    unique_keys, codes = np.unique(period_keys, return_inverse=True)
+    years = pd.Index(unique_keys // 4).astype(str)
+    quarters = pd.Index(unique_keys % 4 + 1).astype(str)
 
-    df['year'] = df['date'].dt.year
-    df['quarter'] = df['date'].dt.quarter
-    
-    subset = df[df['security'] == security].copy()
-    
     # Concatenates the quarter and year together to create an easy to read notation
-    subset['quarter'] = subset['quarter'].astype(str)
-    subset['year'] = subset['year'].astype(str)
-    subset['quarter_year'] = 'Q' + subset['quarter'] + ' ' + subset['year']    
-    
-    return subset
+    labels = 'Q' + quarters + ' ' + years
+
+    # Compact mode keeps the year and quarter as small numbers and the labels as a categorical
+    policy = get_dtype_policy()
+    if policy['period_dtype'] is not None:
+        return ((unique_keys // 4).astype(policy['period_dtype'])[codes],
+                (unique_keys % 4 + 1).astype(policy['period_dtype'])[codes],
+                pd.Categorical.from_codes(codes, categories=labels))
+
+    return years.take(codes), quarters.take(codes), labels.take(codes)
+
+# Adds a column that has the quarter and year combined
+@memoize
+def data_prep(df, security, col):
+    return normalize_long(df[df['security'] == security], col)
 
 # Splits apart the indexes and puts them into a dictionary, good for a column with many different indexes
+@memoize
 def prep_dfs(df, index_list, column_name):
-    prepared_dfs = {}
+    # Normalizes only the rows that are needed a single time, then splits them apart with one groupby
+    normalized = normalize_long(df[df['security'].isin(index_list)], column_name)
+    groups = normalized.groupby('security', sort=False, observed=True).indices
 
+    prepared_dfs = {}
     for index in index_list:
-        prepared_dfs[index] = data_prep(df, index, column_name)
+        prepared_dfs[index] = normalized.take(groups.get(index, []))
 
     return prepared_dfs
 
+# Runs the chosen calculation for every security at once using group aggregations
+def group_calculation(df, column_name, calc=None, date1=None, date2=None):
+    values = df[column_name].astype('float64')
+    grouped = values.groupby(df['security'], sort=False, observed=True)
+
+    if (calc == 'z-score'):
+        # The last row of each security, the same value as iloc[-1] on its filtered df
+        is_last = ~df['security'].duplicated(keep='last')
+        last_values = pd.Series(values[is_last].to_numpy(), index=df.loc[is_last, 'security'])
+        return (last_values - grouped.mean()) / grouped.std()
+    elif (calc == 'mean'):
+        return grouped.mean()
+    elif (calc == 'annualized return'):
+        # Annualizes each security's full cumulative return over the given dates
+        days = (date2 - date1).days
+        total_return = (1 + values).groupby(df['security'], sort=False, observed=True).prod() - 1
+        return ((1 + total_return) ** (365 / days)) - 1
+    else:
+        return pd.Series(0.0, index=df['security'].unique())
+
 # Creates a z-score, table, and prepared df based on the df, indexs, and column name given
+@memoize
 def process_indices(df, index_list, column_name, calc=None, date1=None, date2=None):
     # Creates blank dictionaries to be filled 
     calculation = {}
     tables = {}
     prepared_dfs = {}
 
-    # Iterates over all the values in the index list and creates the specified lists
-    for index in index_list:
-        # Filter the dataframe based on the index given
-        index_df = df[df['security'] == index]
+    # Normalizes the needed rows a single time instead of once per security
+    normalized = normalize_long(df[df['security'].isin(index_list)], column_name)
 
-        if (calc == 'z-score'):
-            val = z_score(index_df, column_name)
-        elif (calc == 'mean'):
-            val = index_df[column_name].mean()
-        elif (calc == 'annualized return'):
-            val = annualized_return(index_df, column_name, date1, date2)
-        else:
-            val = 0
+    # All of the calculations are done together, then each security is pulled out of one groupby
+    values = group_calculation(normalized, column_name, calc, date1, date2).reindex(index_list)
+    groups = normalized.groupby('security', sort=False, observed=True).indices
 
+    # Iterates over all the values in the index list and creates the specified lists
+    for index in index_list:
+        val = values[index]
         calculation[index] = f"{val:.2f}"
 
         # Store the z-scores in the dataframe for use in tables on graph
         tables[index] = pd.DataFrame({calc: [f"{val:.2f}"]})
         
         # Prepare data with new column and only the specified index
-        prepared_dfs[index] = data_prep(df, index, column_name)
+        prepared_dfs[index] = normalized.take(groups.get(index, []))
 
     return calculation, tables, prepared_dfs
 
+# Finds the rows that fall on the last date of each week, month, quarter or year, built once per df and reused
+class PeriodEndIndex:
+    def __init__(self, dates):
+        self.dates = pd.to_datetime(pd.Series(dates)).to_numpy()
+        self.positions = {}
+
+    @classmethod
+    def from_df(cls, df):
+        return cls(df['date'])
+
+    def __len__(self):
+        return len(self.dates)
+
+    # Checks the index was built from the same dates as the df, not just the same number of rows
+    def matches(self, df):
+        return len(self) == len(df) and np.array_equal(self.dates, pd.to_datetime(df['date']).to_numpy())
+
+    # Row positions for the period ends, worked out the first time each period is asked for
+    def ends(self, period='quarterly'):
+        if period not in self.positions:
+            keys = pd.DatetimeIndex(self.dates).to_period(period_codes[period]).asi8
+            unique_keys, codes = np.unique(keys, return_inverse=True)
+
+            # Sorting by date also sorts the periods, so a binary search gives the last date in every period
+            order = np.argsort(self.dates, kind='stable')
+            last_rows = np.searchsorted(keys[order], unique_keys, side='right') - 1
+            last_dates = self.dates[order][last_rows]
+
+            # Every row on its period's last date is kept, in the same order as the df
+            self.positions[period] = np.flatnonzero(self.dates == last_dates[codes])
+        return self.positions[period]
+
+    # Takes the period end rows from the df, start_idx and end_idx pick a range of those rows
+    def take(self, df, period='quarterly', start_idx=None, end_idx=None):
+        positions = self.ends(period)
+        if start_idx is not None and end_idx is not None:
+            positions = positions[start_idx:end_idx]
+        return df.iloc[positions]
+
+# Builds a period end index for each df in a dictionary of prepared df's so the plots can reuse them
+def build_period_indexes(prepared_dfs):
+    return {index: PeriodEndIndex.from_df(df) for index, df in prepared_dfs.items()}
+
+# Returns only the df with the data at the end of each week, month, quarter or year
+def get_last_day_each_period(df, period='quarterly', start_idx=None, end_idx=None, period_index=None):
+    if period_index is None or not period_index.matches(df):
+        period_index = PeriodEndIndex.from_df(df)
+
+    # Only the selected rows are copied, the given df is left as it is
+    filtered_df = period_index.take(df, period, start_idx, end_idx).copy()
+    filtered_df['date'] = pd.to_datetime(filtered_df['date'])
+
+    # Selects the year and the quarter based on the given date, compact mode keeps them as small numbers
+    period_dtype = get_dtype_policy()['period_dtype']
+    filtered_df['year'] = filtered_df['date'].dt.year
+    filtered_df['quarter'] = filtered_df['date'].dt.quarter
+    if period_dtype is not None:
+        filtered_df = filtered_df.astype({'year': period_dtype, 'quarter': period_dtype})
+
+    return filtered_df
+
 # Returns only the df with the data at the end of each quarter
-def get_last_day_each_quarter(df, start_idx=None, end_idx=None):
+@memoize
+def get_last_day_each_quarter(df, start_idx=None, end_idx=None, period_index=None):
+    return get_last_day_each_period(df, 'quarterly', start_idx, end_idx, period_index)
+
+#### Aligning series ####
+
+# Turns a long df (date, security, values) or a wide df (date plus a column per security) into a wide df
+def to_wide(df):
+    df = df.copy()
     df['date'] = pd.to_datetime(df['date'])
-    
-    # Selects the year and the quarter based on the given date
-    df['year'] = df['date'].dt.year
-    df['quarter'] = df['date'].dt.quarter
-
-    # Finds the maximum date within each quarter and saves them off into a df
-    last_dates = df.groupby(['year', 'quarter'])['date'].transform('max')
-    # Selects only the last dates from the df which gets us the final df
-    filtered_df = df[df['date'] == last_dates]
-
-    # Selects the given range of values based on the inputs to the function
-    if start_idx is not None and end_idx is not None:
-        return filtered_df.iloc[start_idx:end_idx]
+
+    if 'security' not in df.columns:
+        return df.groupby('date', sort=True).last()
+
+    value_cols = [col for col in df.columns if col not in ('date', 'security')]
+    wide = df.pivot_table(index='date', columns='security', values=value_cols, aggfunc='last', sort=True)
+    # A single value column keeps the security names, several are named like "CPI YOY Index PX_LAST"
+    if len(value_cols) == 1:
+        wide.columns = wide.columns.get_level_values('security')
+    else:
+        wide.columns = [f"{security} {col}" for col, security in wide.columns]
+    return wide
+
+# Lines up many long and wide series on one calendar of dates in a single pass
+# how='asof' takes the latest value on or before each date (no older than tolerance when given), 'ffill' is the same with no limit,
+# 'exact' only keeps values on matching dates, and 'period_end' gives every date the value reported in its own period
+@memoize
+def align_series(frames, calendar=None, how='asof', tolerance=None, period='monthly'):
+    if isinstance(frames, dict):
+        frames = list(frames.values())
+
+    # All the series share one sorted source date index
+    source = pd.concat([to_wide(frame) for frame in frames], axis=1, sort=True)
+    source_dates = source.index.to_numpy()
+    values = source.to_numpy(dtype='float64')
+
+    if calendar is None:
+        target_dates = source_dates
     else:
-        return filtered_df
-    
+        target_dates = np.sort(pd.to_datetime(np.asarray(calendar)).to_numpy().astype(source_dates.dtype))
 
-# Converts all the raw data into the formatted data using specified keywords
-def convert_deltas_to_percent(df, last_as_percent=True):
-    delta_keywords = ["ΔDay", "ΔWTD", "ΔMTD", "ΔQTD", "ΔYTD", "Δ1Yr", "Δ3Yr", "Δ5Yr", "Yield", "Earn Yld", "Div Yld",
-                      "ROE", "Margins", "Margin", "Last"]
-    multiple_keywords = ["Tr/PE", "Fwd P/E", "EV/EBITDA", "P/Book"]
-    
-    for col in df.columns:
+    # For each row and column, the row of the latest value that is not missing
+    rows = np.arange(len(source_dates))[:, None]
+    last_valid = np.maximum.accumulate(np.where(np.isnan(values), -1, rows), axis=0)
+
+    if how == 'exact':
+        positions = np.searchsorted(source_dates, target_dates, side='left')
+        found = (positions < len(source_dates)) & (source_dates[np.minimum(positions, len(source_dates) - 1)] == target_dates)
+        taken = np.where(found[:, None], values[np.minimum(positions, len(source_dates) - 1)], np.nan)
+
+    elif how in ('asof', 'ffill', 'period_end'):
+        if how == 'period_end':
+            # Every target date looks up to the end of its period instead of to the date itself
+            lookup_dates = pd.DatetimeIndex(target_dates).to_period(period_codes[period]).end_time.to_numpy().astype(source_dates.dtype)
+        else:
+            lookup_dates = target_dates
+
+        # Binary search for the latest source row on or before each lookup date
+        positions = np.searchsorted(source_dates, lookup_dates, side='right') - 1
+        source_rows = np.where(positions[:, None] >= 0, last_valid[np.maximum(positions, 0)], -1)
+        taken = np.take_along_axis(values, np.maximum(source_rows, 0), axis=0)
+        keep = source_rows >= 0
+
+        if how == 'period_end':
+            # The value has to come from inside the same period
+            period_starts = pd.DatetimeIndex(target_dates).to_period(period_codes[period]).start_time.to_numpy().astype(source_dates.dtype)
+            keep &= source_dates[np.maximum(source_rows, 0)] >= period_starts[:, None]
+        elif how == 'asof' and tolerance is not None:
+            keep &= source_dates[np.maximum(source_rows, 0)] >= (target_dates - pd.Timedelta(tolerance).to_timedelta64())[:, None]
+
+        taken = np.where(keep, taken, np.nan)
+
+    else:
+        raise ValueError("how must be 'asof', 'ffill', 'exact' or 'period_end'")
+
+    aligned = pd.DataFrame(taken, columns=source.columns)
+    aligned.insert(0, 'date', target_dates)
+    return apply_result_dtype(aligned)
+
+#### Formatting tables ####
+
+delta_keywords = ["ΔDay", "ΔWTD", "ΔMTD", "ΔQTD", "ΔYTD", "Δ1Yr", "Δ3Yr", "Δ5Yr", "Yield", "Earn Yld", "Div Yld",
+                  "ROE", "Margins", "Margin", "Last"]
+multiple_keywords = ["Tr/PE", "Fwd P/E", "EV/EBITDA", "P/Book"]
+
+# The formats that can be given to a column
+formatters = {
+    'percent': lambda x: f"{x * 100:.2f}%",
+    'comma': lambda x: f"{x:,}",
+    'multiple': lambda x: f"{x:.2f}x",
+    'dollars': lambda x: f"${int(x):,.2f}",
+    'level': lambda x: f"{int(x):,}",
+    'spot': lambda x: f"{x:,.3f}"
+}
+
+# Works out which format each column gets from the keyword rules, done once for a set of column names
+@functools.lru_cache(maxsize=256)
+def compile_format_plan(columns, last_as_percent=True):
+    plan = {}
+    for col in columns:
         col_str = str(col)
-        
+
         if col_str == "Last":
-            if last_as_percent:
-                df[col] = df[col].apply(
-                    lambda x: f"{x * 100:.2f}%" if pd.notnull(x) and isinstance(x, (int, float)) else x
-                )
-            else:
-                # Just leave as-is or format normally with commas
-                df[col] = df[col].apply(
-                    lambda x: f"{x:,}" if pd.notnull(x) and isinstance(x, (int, float)) else x
-                )
-                
-        if any(keyword in col_str for keyword in delta_keywords): 
-            df[col] = df[col].apply(
-                lambda x: f"{x * 100:.2f}%" if pd.notnull(x) and isinstance(x, (int, float)) else x
-            )
-        
+            plan[col] = 'percent' if last_as_percent else 'comma'
+        elif any(keyword in col_str for keyword in delta_keywords):
+            plan[col] = 'percent'
         elif any(keyword in col_str for keyword in multiple_keywords):
-            df[col] = df[col].apply(
-                lambda x: f"{x:.2f}x" if pd.notnull(x) and isinstance(x, (int, float)) else x
-            )
-            
+            plan[col] = 'multiple'
         elif "Earnings" in col_str:
-            df[col] = df[col].apply(
-                lambda x: f"${int(x):,.2f}" if pd.notnull(x) and isinstance(x, (int, float)) else x
-            )
-            
+            plan[col] = 'dollars'
         elif "Level" in col_str:
-            df[col] = df[col].apply(
-                lambda x: f"{int(x):,}" if pd.notnull(x) and isinstance(x, (int, float)) else x
-            )
-        
+            plan[col] = 'level'
         elif "Spot" in col_str:
-            df[col] = df[col].apply(
-                lambda x: f"{x:,.3f}" if pd.notnull(x) and isinstance(x, (int, float)) else x
-            )
+            plan[col] = 'spot'
+
+    return plan
+
+# Formats a whole column, each unique number is only formatted once and then looked up by every cell that has it
+def format_column(series, format_name):
+    values = series.to_numpy()
+
+    # Only numbers get formatted, text and missing values are left as they are
+    if values.dtype.kind in 'iuf':
+        numbers = pd.notnull(values)
+        integers = numbers & (values.dtype.kind in 'iu')
+    else:
+        numbers = np.array([isinstance(x, (int, float, np.number)) and not isinstance(x, (bool, np.bool_)) and pd.notnull(x)
+                            for x in values], dtype=bool)
+        integers = numbers & np.array([isinstance(x, (int, np.integer)) for x in values], dtype=bool)
+    if not numbers.any():
+        return series
+
+    formatted = values.astype(object)
+    # Integers are formatted from their own values so they keep their integer look and every digit,
+    # only the other numbers are turned into floats
+    for group, group_values in ((integers, values[integers]), (numbers & ~integers, values[numbers & ~integers].astype('float64'))):
+        if not group.any():
+            continue
+        unique_values, codes = np.unique(group_values, return_inverse=True)
+        labels = np.array([formatters[format_name](x) for x in unique_values.tolist()], dtype=object)
+        formatted[group] = labels[codes.ravel()]
+    # Compact mode keeps the repeated labels as a categorical instead of a string for every cell
+    if get_dtype_policy()['labels'] == 'category':
+        return pd.Series(pd.Categorical(formatted), index=series.index, name=series.name)
+    return pd.Series(formatted, index=series.index, name=series.name)
+
+# Builds the formatted table and keeps the raw numbers next to it, gives back (raw_df, display_df) for plot_styled_table
+def format_table(df, last_as_percent=True):
+    plan = compile_format_plan(tuple(df.columns), last_as_percent)
+    display_df = df.copy()
+    for col, format_name in plan.items():
+        display_df[col] = format_column(df[col], format_name)
+    return df, display_df
+
+# Converts all the raw data into the formatted data using specified keywords
+def convert_deltas_to_percent(df, last_as_percent=True):
+    plan = compile_format_plan(tuple(df.columns), last_as_percent)
+    for col, format_name in plan.items():
+        df[col] = format_column(df[col], format_name)
 
     return df
 
+#### Sectors ####
+
+# Keywords and the sector they belong to, checked in order so the first match wins
+# Add your own aliases by passing a longer list, e.g. sector_rules + [("Info Tech", "Information Technology")]
+sector_rules = [
+    ("Industrials", "Industrials"),
+    ("Financials", "Financials"),
+    ("Consumer Discretionary", "Consumer Discretionary"),
+    ("Information Technology", "Information Technology"),
+    ("Health Care", "Health Care"),
+    ("Real Estate", "Real Estate"),
+    ("Materials", "Materials"),
+    ("Consumer Staples", "Consumer Staples"),
+    ("Energy", "Energy"),
+    ("Utilities", "Utilities"),
+    ("Communication Services", "Communication Services")
+]
+
 # Allows for cleaning up of sector names
-def map_to_sector(name):
-    if "Industrials" in name:
-        return "Industrials"
-    if "Financials" in name:
-        return "Financials"
-    if "Consumer Discretionary" in name:
-        return "Consumer Discretionary"
-    if "Information Technology" in name:
-        return "Information Technology"
-    if "Health Care" in name:
-        return "Health Care"
-    if "Real Estate" in name:
-        return "Real Estate"
-    if "Materials" in name:
-        return "Materials"
-    if "Consumer Staples" in name:
-        return "Consumer Staples"
-    if "Energy" in name:
-        return "Energy"
-    if "Utilities" in name:
-        return "Utilities"
-    if "Communication Services" in name:
-        return "Communication Services"
-    return name
\ No newline at end of file
+def map_to_sector(name, rules=None):
+    for keyword, sector in (sector_rules if rules is None else rules):
+        if keyword in name:
+            return sector
+    return name
+
+# Cleans up the sector names for a whole column at once and gives back a pandas Categorical
+def map_sectors(names, rules=None):
+    rules = sector_rules if rules is None else rules
+    # The matching is only done for each unique name, the rows then share the result through their codes
+    codes, uniques = pd.factorize(pd.Series(names), use_na_sentinel=True)
+    unique_names = pd.Series(uniques, dtype=object).astype(str)
+    # With no rules every name is kept as it is, the same as map_to_sector
+    if len(rules) == 0:
+        return pd.Categorical.from_codes(codes, categories=unique_names.to_numpy(dtype=object))
+
+    # One column of matches per rule, the first rule that matches each name wins
+    matches = np.column_stack([unique_names.str.contains(keyword, regex=False).to_numpy() for keyword, _ in rules])
+    first_match = matches.argmax(axis=1)
+    sectors = np.array([sector for _, sector in rules], dtype=object)
+    mapped = np.where(matches.any(axis=1), sectors[first_match], unique_names.to_numpy(dtype=object))
+
+    categories = pd.unique(mapped)
+    mapped_codes = pd.Index(categories).get_indexer(mapped)
+    # Missing names keep the missing code of -1
+    return pd.Categorical.from_codes(np.where(codes >= 0, mapped_codes[codes], -1), categories=categories)
+
+
+#### Loading data ####
+
+# Version of the cache layout, bumped whenever the files written by load_csv_cached change
+cache_version = 2
+
+# Gives back what the cache needs to know to tell if the source file has changed
+def source_signature(path, validate='mtime'):
+    info = os.stat(path)
+    signature = {'size': info.st_size, 'mtime_ns': info.st_mtime_ns}
+    if validate == 'hash':
+        # Hashing reads the whole file, but still catches a changed file that kept its size and mtime
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        signature = {'size': info.st_size, 'hash': digest.hexdigest()}
+    return signature
+
+# Reads the cache back in, the arrays are memory-mapped from disk unless mmap is False
+# The pages are copy-on-write, so the df can be changed like one from pd.read_csv without touching the cache
+def read_column_cache(cache_dir, meta, mmap=True):
+    mmap_mode = 'c' if mmap else None
+    data = {}
+    for position, column in enumerate(meta['columns']):
+        values = np.load(os.path.join(cache_dir, f'{position}.npy'), mmap_mode=mmap_mode)
+        if column['kind'] == 'date':
+            data[column['name']] = pd.DatetimeIndex(values)
+        elif column['kind'] == 'category':
+            data[column['name']] = pd.Categorical.from_codes(values, categories=column['categories'])
+        else:
+            data[column['name']] = values
+    return pd.DataFrame(data, copy=False)
+
+# Saves each column as its own .npy file with a json file that describes them
+def write_column_cache(df, cache_dir, signature, date_cols, value_dtype, requested_date_cols):
+    # Written to a temporary folder first and then moved so a half written cache is never read
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(cache_dir)))
+    columns = []
+    for position, name in enumerate(df.columns):
+        series = df[name]
+        if name in date_cols:
+            values = pd.to_datetime(series).to_numpy().astype('datetime64[ns]')
+            columns.append({'name': name, 'kind': 'date'})
+        elif pd.api.types.is_integer_dtype(series) and not series.hasnans:
+            # Whole numbers keep their own type since float32 can not hold every large integer exactly
+            values = series.to_numpy()
+            columns.append({'name': name, 'kind': 'values'})
+        elif pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            values = series.to_numpy(dtype=value_dtype)
+            columns.append({'name': name, 'kind': 'values'})
+        else:
+            categorical = pd.Categorical(series)
+            values = categorical.codes.astype('int32')
+            columns.append({'name': name, 'kind': 'category', 'categories': categorical.categories.tolist()})
+        np.save(os.path.join(temp_dir, f'{position}.npy'), values)
+
+    meta = {'version': cache_version, 'source': signature, 'value_dtype': value_dtype,
+            'date_cols': requested_date_cols, 'columns': columns}
+    with open(os.path.join(temp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(temp_dir, cache_dir)
+    return meta
+
+# Loads a csv through a binary cache, the first load parses the csv and later loads read the saved columns
+# Dates are stored as datetime64, integers keep their type, other numbers are stored as float32 and text columns like security as categoricals
+# The cache is rebuilt when the csv's modified time or size changes, or its contents when validate='hash',
+# and when it was built with a different value_dtype or date_cols
+def load_csv_cached(path, cache_dir=None, date_cols=('date',), value_dtype='float32', validate='mtime', mmap=True):
+    cache_dir = f'{path}.psfcache' if cache_dir is None else cache_dir
+    signature = source_signature(path, validate)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    requested_date_cols = list(date_cols)
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if (meta.get('version') == cache_version and meta.get('source') == signature and meta.get('value_dtype') == value_dtype
+                and meta.get('date_cols') == requested_date_cols):
+            return read_column_cache(cache_dir, meta, mmap)
+
+    df = pd.read_csv(path)
+    date_cols = [col for col in date_cols if col in df.columns]
+    meta = write_column_cache(df, cache_dir, signature, date_cols, value_dtype, requested_date_cols)
+    return read_column_cache(cache_dir, meta, mmap)
+
+#### Streaming large files ####
+
+# Running per-security statistics that are merged one chunk at a time, enough for the process_indices calculations
+class IndexStatsAccumulator:
+    def __init__(self):
+        self.stats = pd.DataFrame(columns=['count', 'mean', 'm2', 'growth', 'last'], dtype='float64')
+        self.stats.index.name = 'security'
+
+    # Merges the statistics of one normalized chunk into the running totals
+    def update(self, chunk, column_name):
+        values = chunk[column_name].astype('float64')
+        grouped = values.groupby(chunk['security'], sort=False, observed=True)
+
+        # Summaries for the chunk, m2 is the sum of squared differences from the mean
+        chunk_stats = pd.DataFrame({
+            'count': grouped.count().astype('float64'),
+            'mean': grouped.mean(),
+            'm2': grouped.var(ddof=0) * grouped.count(),
+            'growth': (1 + values).groupby(chunk['security'], sort=False, observed=True).prod(),
+        })
+        is_last = ~chunk['security'].duplicated(keep='last')
+        chunk_stats['last'] = pd.Series(values[is_last].to_numpy(), index=chunk.loc[is_last, 'security'].astype(object))
+        chunk_stats.index = chunk_stats.index.astype(object)
+
+        # A security with only missing values in the chunk adds nothing to the totals
+        chunk_stats[['mean', 'm2']] = chunk_stats[['mean', 'm2']].fillna(0.0)
+
+        # Combines the chunk with what was seen before using the parallel mean and variance update
+        old = self.stats.reindex(chunk_stats.index)
+        old_count = old['count'].fillna(0.0)
+        old_mean = old['mean'].fillna(0.0)
+        count = old_count + chunk_stats['count']
+        delta = chunk_stats['mean'] - old_mean
+        weight = (chunk_stats['count'] / count).where(count > 0, 0.0)
+
+        merged = pd.DataFrame({
+            'count': count,
+            'mean': old_mean + delta * weight,
+            'm2': old['m2'].fillna(0.0) + chunk_stats['m2'] + delta ** 2 * old_count * weight,
+            'growth': old['growth'].fillna(1.0) * chunk_stats['growth'],
+            'last': chunk_stats['last']
+        })
+
+        new_securities = merged.index.difference(self.stats.index, sort=False)
+        self.stats = pd.concat([self.stats, merged.loc[new_securities]]) if len(self.stats) else merged.copy()
+        self.stats.loc[merged.index] = merged
+        return self
+
+    # The same results as group_calculation gives for the full file
+    def value(self, calc=None, date1=None, date2=None):
+        stats = self.stats
+        if (calc == 'z-score'):
+            return (stats['last'] - stats['mean']) / np.sqrt(stats['m2'] / (stats['count'] - 1))
+        elif (calc == 'mean'):
+            return stats['mean']
+        elif (calc == 'annualized return'):
+            days = (date2 - date1).days
+            return (stats['growth'] ** (365 / days)) - 1
+        else:
+            return pd.Series(0.0, index=stats.index)
+
+# Works through a long csv in chunks so memory stays bounded by chunksize instead of the size of the file
+# Each chunk is normalized like prep_dfs and the process_indices statistics are built up as it goes
+# Only the statistics are kept by default so memory stays bounded by chunksize, the third result is then None
+# With store_dir, each security's rows are appended to its own csv there and the paths are given back instead of df's
+# keep_prepared=True holds every row in memory and gives back the prepared df's like process_indices
+def stream_process_indices(path, index_list, column_name, calc=None, date1=None, date2=None, chunksize=100_000, store_dir=None,
+                           keep_prepared=False):
+    accumulator = IndexStatsAccumulator()
+    pieces = {index: [] for index in index_list}
+    paths = {}
+
+    if store_dir is not None:
+        os.makedirs(store_dir, exist_ok=True)
+        for index in index_list:
+            paths[index] = os.path.join(store_dir, f'{index}.csv')
+            if os.path.exists(paths[index]):
+                os.remove(paths[index])
+
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        normalized = normalize_long(chunk[chunk['security'].isin(index_list)], column_name)
+        if normalized.empty:
+            continue
+        accumulator.update(normalized, column_name)
+        if store_dir is None and not keep_prepared:
+            continue
+
+        # Routes the rows of each security to where they are being kept
+        for index, positions in normalized.groupby('security', sort=False, observed=True).indices.items():
+            rows = normalized.take(positions)
+            if store_dir is None:
+                pieces[index].append(rows)
+            else:
+                rows.to_csv(paths[index], mode='a', header=not os.path.exists(paths[index]), index=False)
+
+    values = accumulator.value(calc, date1, date2).reindex(index_list)
+    calculation = {}
+    tables = {}
+    for index in index_list:
+        val = values[index]
+        calculation[index] = f"{val:.2f}"
+        tables[index] = pd.DataFrame({calc: [f"{val:.2f}"]})
+
+    if store_dir is not None:
+        return calculation, tables, paths
+    if not keep_prepared:
+        return calculation, tables, None
+
+    prepared_dfs = {index: pd.concat(pieces[index]) if pieces[index] else pd.DataFrame() for index in index_list}
+    return calculation, tables, prepared_dfs
+
+#### Incremental history ####
+
+# Append-only history of long-format data (date, security, values) that keeps track of what changed
+# Prepared df's, process_indices statistics, period ends and rolling returns are only recomputed for the new rows
+# With store_dir, each security's rows are also appended to its own csv there, the same layout as stream_process_indices
+class HistoryStore:
+    def __init__(self, column_name, store_dir=None):
+        self.column_name = column_name
+        self.store_dir = store_dir
+        self.frames = {}
+        self.changed = {}
+        self.cache = {}
+
+        if store_dir is not None:
+            os.makedirs(store_dir, exist_ok=True)
+            for file_name in sorted(os.listdir(store_dir)):
+                if file_name.endswith('.csv'):
+                    saved = pd.read_csv(os.path.join(store_dir, file_name))
+                    self.frames[saved['security'].iloc[0]] = normalize_long(saved, column_name).reset_index(drop=True)
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def securities(self):
+        return list(self.frames)
+
+    # Adds new rows, every security's new dates have to come after the dates it already has
+    def append(self, rows):
+        normalized = normalize_long(rows, self.column_name).sort_values('date', kind='stable')
+        batch = {security: normalized.take(positions).reset_index(drop=True)
+                 for security, positions in normalized.groupby('security', sort=False, observed=True).indices.items()}
+
+        # Every security is checked before anything changes so a rejected batch leaves the store as it was
+        for security, new_rows in batch.items():
+            current = self.frames.get(security)
+            if current is not None and len(current) and new_rows['date'].iloc[0] <= current['date'].iloc[-1]:
+                raise ValueError(f"New rows for {security} must come after {current['date'].iloc[-1].date()}")
+
+        for security, new_rows in batch.items():
+            current = self.frames.get(security)
+            start = 0 if current is None else len(current)
+            self.frames[security] = new_rows if current is None else pd.concat([current, new_rows], ignore_index=True)
+            # Keeps the first changed row and date for every security until mark_clean is called
+            if security not in self.changed:
+                self.changed[security] = (start, new_rows['date'].iloc[0])
+
+            if self.store_dir is not None:
+                path = os.path.join(self.store_dir, f'{security}.csv')
+                new_rows.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+
+        return self
+
+    # Securities that changed since the last mark_clean and the first date that changed for each
+    def dirty(self):
+        return {security: (first_date, self.frames[security]['date'].iloc[-1]) for security, (_, first_date) in self.changed.items()}
+
+    def mark_clean(self):
+        self.changed = {}
+
+    # The prepared df for a security, the same as data_prep gives
+    def prepared(self, security):
+        return self.frames[security]
+
+    # The prepared df's for a list of securities, the same as prep_dfs gives
+    def prepared_dfs(self, index_list=None):
+        index_list = self.securities if index_list is None else index_list
+        return {index: self.frames[index] for index in index_list}
+
+    # Gives back a cached result and the number of rows it was built from
+    def _cached(self, key):
+        return self.cache.get(key, (0, None))
+
+    # The process_indices results, each security's statistics only take in the rows added since the last call
+    def process_indices(self, index_list=None, calc=None, date1=None, date2=None):
+        index_list = self.securities if index_list is None else index_list
+        seen, accumulator = self._cached('stats')
+        accumulator = accumulator or IndexStatsAccumulator()
+        seen = dict(seen or {})
+
+        for security in index_list:
+            frame = self.frames.get(security)
+            if frame is None or seen.get(security, 0) == len(frame):
+                continue
+            accumulator.update(frame.iloc[seen.get(security, 0):], self.column_name)
+            seen[security] = len(frame)
+        self.cache['stats'] = (seen, accumulator)
+
+        values = accumulator.value(calc, date1, date2).reindex(index_list)
+        calculation = {index: f"{values[index]:.2f}" for index in index_list}
+        tables = {index: pd.DataFrame({calc: [calculation[index]]}) for index in index_list}
+        return calculation, tables, self.prepared_dfs(index_list)
+
+    # Period end rows for a security, only the periods from the last one already seen onward are looked at again
+    def period_ends(self, security, period='quarterly'):
+        frame = self.frames[security]
+        seen, positions = self._cached(('period_ends', security, period))
+
+        if seen != len(frame):
+            if positions is None or len(positions) == 0:
+                positions = PeriodEndIndex(frame['date']).ends(period)
+            else:
+                # The last period seen before can still move its end date, so it is worked out again with the new rows
+                tail_start = np.searchsorted(frame['date'].to_numpy(), pd.Period(frame['date'].iloc[positions[-1]], period_codes[period]).start_time.to_datetime64())
+                tail = PeriodEndIndex(frame['date'].iloc[tail_start:]).ends(period) + tail_start
+                positions = np.concatenate([positions[positions < tail_start], tail])
+            self.cache[('period_ends', security, period)] = (len(frame), positions)
+
+        return frame.iloc[positions]
+
+    # compute_rolling_returns for a security, only the new rows and the window before them are recomputed
+    def rolling_returns(self, security, time_period, return_periods, risk_free_rate):
+        frame = self.frames[security][['date', self.column_name]]
+        key = ('rolling_returns', security, time_period, return_periods, risk_free_rate)
+        seen, cached = self._cached(key)
+        returns = frame[self.column_name].to_numpy(dtype='float64')
+
+        if cached is None:
+            result = compute_rolling_returns(frame, time_period, return_periods, risk_free_rate)
+            # The running growth skips missing returns the same way cumprod does in the batch calc
+            growth = np.nanprod(1 + returns)
+        else:
+            result, growth = cached
+            if seen != len(frame):
+                # Enough rows before the new ones to fill the first new window
+                window = time_period * 12
+                start = max(seen - window + 1, 0)
+                tail = compute_rolling_returns(frame.iloc[start:], time_period, return_periods, risk_free_rate).iloc[seen - start:]
+
+                # The cumulative return carries on from the running growth of the rows already seen
+                tail_returns = returns[seen:]
+                tail_growth = growth * np.nancumprod(1 + tail_returns)
+                tail = tail.assign(cumulative_return=np.where(np.isnan(tail_returns), np.nan, tail_growth - 1))
+                result = pd.concat([result, tail], ignore_index=True)
+                growth = tail_growth[-1]
+
+        self.cache[key] = (len(frame), (result, growth))
+        return result
+
+
+#### Memory ####
+
+# Memory in bytes used by a df, or by every df in a dictionary of them
+def memory_usage(data):
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        return int(np.sum(data.memory_usage(deep=True)))
+    if isinstance(data, dict):
+        return sum(memory_usage(item) for item in data.values())
+    return 0
+
+# Compares how much memory the prepared df's and return calculations take in each dtype mode
+def dtype_memory_report(df, column_name, index_list=None, returns_df=None, time_period=1, return_periods='daily'):
+    index_list = list(df['security'].unique()) if index_list is None else index_list
+    report = {}
+
+    for mode in policies:
+        with dtype_policy(mode):
+            row = {'prepared_dfs': memory_usage(prep_dfs(df, index_list, column_name))}
+            if returns_df is not None:
+                row['split_returns'] = memory_usage(dict(split_returns_cols(returns_df, 'date')))
+                row['rolling_returns'] = memory_usage(compute_panel_rolling_returns(returns_df, time_period, return_periods, 0.0))
+            report[mode] = row
+
+    report = pd.DataFrame(report).T
+    report['total'] = report.sum(axis=1)
+    report.index.name = 'mode'
+    return report
@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+import pandas as pd
+
+'''
+One setting that decides the data types used across cleaning and calcs
+compact keeps values and results as float32, text like security and quarter_year as categoricals, and year/quarter as int16
+standard is how the library has always worked, float32 values from data_prep and float64 results from calcs
+precise keeps everything as float64 and compounds returns with exact products instead of log sums
+'''
+
+policies = {
+    'compact': {'value_dtype': 'float32', 'other_value_dtype': 'float32', 'split_dtype': 'float32', 'result_dtype': 'float32', 'labels': 'category', 'period_dtype': 'int16'},
+    'standard': {'value_dtype': 'float32', 'other_value_dtype': None, 'split_dtype': None, 'result_dtype': 'float64', 'labels': 'str', 'period_dtype': None},
+    'precise': {'value_dtype': 'float64', 'other_value_dtype': 'float64', 'split_dtype': 'float64', 'result_dtype': 'float64', 'labels': 'str', 'period_dtype': None}
+}
+
+# The mode that is being used right now
+current_policy = {'mode': 'standard'}
+
+# Changes the data type mode for the whole library
+def set_dtype_policy(mode):
+    if mode not in policies:
+        raise ValueError(f"mode must be one of {list(policies)}")
+    current_policy['mode'] = mode
+
+# Gives back the settings for the current mode
+def get_dtype_policy():
+    return dict(policies[current_policy['mode']], mode=current_policy['mode'])
+
+# Uses a mode only inside a with block, then goes back to the mode from before
+@contextmanager
+def dtype_policy(mode):
+    previous = current_policy['mode']
+    set_dtype_policy(mode)
+    try:
+        yield get_dtype_policy()
+    finally:
+        set_dtype_policy(previous)
+
+# Casts the float columns of a calcs result to the result type of the current mode
+# Works on a single df or on every df in a dictionary of results keyed by security
+def apply_result_dtype(df):
+    result_dtype = get_dtype_policy()['result_dtype']
+    if result_dtype == 'float64':
+        return df
+    if isinstance(df, dict):
+        return {key: apply_result_dtype(item) for key, item in df.items()}
+    float_cols = [col for col in df.columns if pd.api.types.is_float_dtype(df[col])]
+    return df.astype({col: result_dtype for col in float_cols})
@@ -0,0 +1,217 @@
+import os
+import json
+from collections.abc import Mapping
+import pandas as pd
+import numpy as np
+from .cleaning import quarter_labels, PeriodEndIndex
+from .calcs import compute_panel_returns, compute_panel_rolling_returns
+from .dtypes import get_dtype_policy
+
+'''
+A compact way to hold many securities that share the same dates
+All the values sit in one 2-D float array (dates x securities) with a single shared date index
+Each security is stored as one contiguous column so handing out a security never copies its values
+It acts like the dictionary of df's from prep_dfs, so it can be passed anywhere prepared_dataframes is used
+Panels can be saved to a folder and opened memory-mapped, then worked through a block of securities at a time
+'''
+
+# A view of an array that cannot be written to, other array-likes such as an Index are already immutable
+def read_only(values):
+    if not isinstance(values, np.ndarray):
+        return values
+    view = values.view()
+    view.setflags(write=False)
+    return view
+
+# The value type for a panel, the given dtype or else the one from the dtype mode (float32 in compact, float64 otherwise)
+def panel_dtype(dtype=None):
+    if dtype is not None:
+        return dtype
+    return get_dtype_policy()['split_dtype'] or 'float64'
+
+class SecurityPanel(Mapping):
+    def __init__(self, dates, values, securities, value_name='value', periods=True):
+        self.dates = pd.to_datetime(np.asarray(dates)).to_numpy()
+        # Column-major order keeps every security's values next to each other in memory
+        # Arrays that already are, like memory-mapped ones, are kept as they are
+        values = values if isinstance(values, np.ndarray) else np.asarray(values, dtype=panel_dtype())
+        self.values = values if values.flags.f_contiguous else np.asfortranarray(values)
+        self.securities = list(securities)
+        self.columns = {security: i for i, security in enumerate(self.securities)}
+        self.value_name = value_name
+
+        # The year, quarter and quarter_year labels are built one time and shared by every security
+        self.periods = quarter_labels(self.dates) if periods else None
+
+    # Builds a panel from a wide df with a date column and a column per security
+    @classmethod
+    def from_wide(cls, df, date='date', value_name='value', dtype=None, periods=True):
+        df = df.sort_values(date)
+        securities = [col for col in df.columns if col != date]
+        values = df[securities].to_numpy(dtype=panel_dtype(dtype))
+        return cls(df[date].to_numpy(), values, securities, value_name, periods)
+
+    # Builds a panel from a long df (date, security, values) using one of the value columns
+    @classmethod
+    def from_long(cls, df, col, dtype=None, periods=True):
+        dates = pd.to_datetime(df['date'])
+        wide = pd.DataFrame({'date': dates, 'security': df['security'], col: df[col]}).pivot_table(
+            index='date', columns='security', values=col, aggfunc='last', sort=True)
+        # Keeps the securities in the order they first show up, the same as prep_dfs
+        securities = list(pd.unique(df['security']))
+        wide = wide.reindex(columns=securities)
+        return cls(wide.index.to_numpy(), wide.to_numpy(dtype=panel_dtype(dtype)), securities, col, periods)
+
+    def __len__(self):
+        return len(self.securities)
+
+    def __iter__(self):
+        return iter(self.securities)
+
+    def __contains__(self, security):
+        return security in self.columns
+
+    # The values of one security as a view of the panel
+    def column(self, security):
+        return self.values[:, self.columns[security]]
+
+    # Gives a df for one security like the ones from prep_dfs, the columns are read-only views of the shared arrays
+    # Writing to it raises an error instead of changing the panel, use .copy() first to get a df that can be changed
+    def __getitem__(self, security):
+        data = {'date': read_only(self.dates), 'security': pd.Categorical.from_codes(
+            np.full(len(self.dates), self.columns[security]), categories=self.securities),
+            self.value_name: read_only(self.column(security))}
+
+        if self.periods is not None:
+            data['year'], data['quarter'], data['quarter_year'] = (read_only(labels) for labels in self.periods)
+
+        return pd.DataFrame(data, copy=False)
+
+    # Position range of the dates between start and end, both included, found with a binary search
+    def date_range(self, start=None, end=None):
+        first = 0 if start is None else np.searchsorted(self.dates, pd.Timestamp(start).to_datetime64(), side='left')
+        last = len(self.dates) if end is None else np.searchsorted(self.dates, pd.Timestamp(end).to_datetime64(), side='right')
+        return first, last
+
+    # A new panel over a range of dates that shares memory with this one
+    def slice_dates(self, start=None, end=None):
+        first, last = self.date_range(start, end)
+        sliced = SecurityPanel.__new__(SecurityPanel)
+        sliced.dates = self.dates[first:last]
+        sliced.values = self.values[first:last]
+        sliced.securities = self.securities
+        sliced.columns = self.columns
+        sliced.value_name = self.value_name
+        sliced.periods = None if self.periods is None else tuple(labels[first:last] for labels in self.periods)
+        return sliced
+
+    # A panel with only some of the securities
+    def select(self, securities):
+        securities = list(securities)
+        positions = [self.columns[security] for security in securities]
+        selected = SecurityPanel.__new__(SecurityPanel)
+        selected.dates = self.dates
+        selected.values = self.values[:, positions]
+        selected.securities = securities
+        selected.columns = {security: i for i, security in enumerate(securities)}
+        selected.value_name = self.value_name
+        selected.periods = self.periods
+        return selected
+
+    # Turns the panel back into a wide df with a date column, ready for the calcs functions
+    def to_wide(self):
+        wide = pd.DataFrame(self.values, columns=self.securities)
+        wide.insert(0, 'date', self.dates)
+        return wide
+
+    # Memory used by the values and dates
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.dates.nbytes
+
+    # Gives wide df's for a few securities at a time, only that block of values is read into memory
+    def iter_blocks(self, block_size=64):
+        for start in range(0, len(self.securities), block_size):
+            securities = self.securities[start:start + block_size]
+            wide = pd.DataFrame(np.array(self.values[:, start:start + block_size]), columns=securities)
+            wide.insert(0, 'date', self.dates)
+            yield securities, wide
+
+    # Writes the panel to a folder so it can be opened later as a memory-mapped panel
+    def save(self, path):
+        panel = create_memmap_panel(path, self.dates, self.securities, self.value_name, self.values.dtype)
+        for start in range(0, len(self.securities), 64):
+            panel.values[:, start:start + 64] = self.values[:, start:start + 64]
+        panel.values.flush()
+        return open_memmap_panel(path)
+
+    def __repr__(self):
+        return f'SecurityPanel({len(self.dates)} dates x {len(self.securities)} securities, {self.value_name})'
+
+
+#### Memory-mapped panels ####
+
+# Makes a new panel folder on disk with an empty values file, fill it through panel.values one block at a time
+# The folder holds values.npy (dates x securities, column-major), dates.npy and meta.json with the securities
+def create_memmap_panel(path, dates, securities, value_name='value', dtype=None):
+    os.makedirs(path, exist_ok=True)
+    dates = pd.to_datetime(np.asarray(dates)).to_numpy().astype('datetime64[ns]')
+    securities = list(securities)
+
+    np.save(os.path.join(path, 'dates.npy'), dates)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'securities': securities, 'value_name': value_name}, f)
+
+    values = np.lib.format.open_memmap(os.path.join(path, 'values.npy'), mode='w+', dtype=panel_dtype(dtype),
+                                       shape=(len(dates), len(securities)), fortran_order=True)
+    values[:] = np.nan
+    return SecurityPanel(dates, values, securities, value_name)
+
+# Opens a panel folder without reading the values, the operating system pages them in as they are used
+# Many processes can open the same folder read-only and share the same pages in memory
+def open_memmap_panel(path, mode='r', periods=True):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    dates = np.load(os.path.join(path, 'dates.npy'))
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode=mode)
+    return SecurityPanel(dates, values, meta['securities'], meta['value_name'], periods)
+
+# Runs compute_panel_returns over a panel one block of securities at a time
+def panel_returns(panel, return_periods, risk_free_rate, block_size=64):
+    summaries = [compute_panel_returns(wide, return_periods, risk_free_rate) for _, wide in panel.iter_blocks(block_size)]
+    return pd.concat(summaries)
+
+# Runs compute_panel_rolling_returns over a panel one block of securities at a time
+# Each metric is written into its own memory-mapped panel under path, so only one block of results is ever in memory
+# Gives a dictionary keyed by metric (cumulative_return, rolling_sharpe, ...) of read-only panels
+def panel_rolling_returns(panel, time_period, return_periods, risk_free_rate, path, block_size=64):
+    outputs = {}
+    for securities, wide in panel.iter_blocks(block_size):
+        results = compute_panel_rolling_returns(wide, time_period, return_periods, risk_free_rate)
+        for security in securities:
+            for metric, values in results[security].drop(columns='date').items():
+                if metric not in outputs:
+                    outputs[metric] = create_memmap_panel(os.path.join(path, metric), panel.dates, panel.securities,
+                                                          metric, get_dtype_policy()['result_dtype'])
+                outputs[metric].values[:, outputs[metric].columns[security]] = values.to_numpy()
+
+    for output in outputs.values():
+        output.values.flush()
+    return {metric: open_memmap_panel(os.path.join(path, metric)) for metric in outputs}
+
+# Z-score of the latest value of every security against its full history, the same as z_score on each column
+def panel_z_scores(panel, block_size=64):
+    scores = []
+    for _, wide in panel.iter_blocks(block_size):
+        values = wide.drop(columns='date')
+        # The panel leaves a security blank on dates it has no value, so its latest value that is not missing
+        # is the same as iloc[-1] on that security's prepared df
+        scores.append((values.ffill().iloc[-1] - values.mean()) / values.std())
+    return pd.concat(scores).rename('z-score')
+
+# Only the rows on the last date of each period, only those rows are read from disk
+def panel_period_ends(panel, period='quarterly', start_idx=None, end_idx=None):
+    positions = PeriodEndIndex(panel.dates).ends(period)
+    if start_idx is not None and end_idx is not None:
+        positions = positions[start_idx:end_idx]
+    return SecurityPanel(panel.dates[positions], np.asarray(panel.values[positions]), panel.securities, panel.value_name)
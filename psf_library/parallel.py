@@ -0,0 +1,113 @@
+import os
+import itertools
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from .calcs import compute_rolling_returns
+
+'''
+Runs the calcs functions across many securities and parameter settings at the same time on a process pool
+The returns are placed in shared memory one time, each worker attaches to it instead of being sent its own copy
+Every task is one security with one set of parameters, and the results come back in the same order as the tasks
+When a pool can not be used everything runs one task at a time in the current process
+'''
+
+# Shared data for the current process, filled by attach_shared in each worker or directly when running serially
+shared = {}
+
+# Attaches a worker to the shared memory block holding the returns
+def attach_shared(name, shape, dtype, dates, securities):
+    block = shared_memory.SharedMemory(name=name)
+    shared['block'] = block
+    shared['values'] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    shared['dates'] = dates
+    shared['securities'] = securities
+
+# Runs a single task on one security, the df only holds the date and that security's column
+def run_task(task):
+    func, security, params = task
+    column = shared['securities'].index(security)
+    security_df = pd.DataFrame({'date': shared['dates'], security: shared['values'][:, column]})
+    result = func(security_df, **params)
+
+    # Every result is turned into rows that are labeled with the security and the parameters
+    if isinstance(result, pd.DataFrame):
+        rows = result.copy()
+    elif isinstance(result, (pd.Series, dict)):
+        rows = pd.DataFrame([dict(result)])
+    else:
+        rows = pd.DataFrame({'value': [result]})
+
+    rows.insert(0, 'security', security)
+    for position, (key, value) in enumerate(params.items(), start=1):
+        rows.insert(position, key, value)
+    return rows
+
+# Runs func(security_df, **params) for every security and every combination in param_grid, then stacks the results
+# func has to be defined at the top level of a module so it can be sent to the workers
+def run_parallel(func, df, param_grid=None, securities=None, max_workers=None):
+    df = df.sort_values('date')
+    securities = [col for col in df.columns if col != 'date'] if securities is None else list(securities)
+    param_grid = param_grid or {}
+
+    # Every combination of the parameters is a task for every security, in a fixed order
+    keys = list(param_grid)
+    combinations = [dict(zip(keys, values)) for values in itertools.product(*param_grid.values())]
+    tasks = [(func, security, params) for security in securities for params in combinations]
+    if not tasks:
+        return pd.DataFrame()
+
+    values = np.ascontiguousarray(df[securities].to_numpy(dtype='float64'))
+    dates = df['date'].to_numpy()
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+
+    results = None
+    if max_workers > 1:
+        block = None
+        pool = None
+        try:
+            # Only setting up the shared memory and starting the workers can fall back to running serially,
+            # an error raised by func inside a worker is passed on to the caller
+            try:
+                # The returns are copied into shared memory one time for every worker to read
+                block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+                pool = ProcessPoolExecutor(max_workers=max_workers, initializer=attach_shared,
+                                           initargs=(block.name, values.shape, values.dtype, dates, securities))
+                futures = [pool.submit(run_task, task) for task in tasks]
+            except OSError:
+                futures = None
+
+            if futures is not None:
+                try:
+                    results = [future.result() for future in futures]
+                except BrokenProcessPool:
+                    results = None
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            if block is not None:
+                block.close()
+                block.unlink()
+
+    # Serial fallback, used for a single worker or when a pool is not available
+    if results is None:
+        shared.update({'values': values, 'dates': dates, 'securities': securities})
+        try:
+            results = [run_task(task) for task in tasks]
+        finally:
+            # The values are only needed while the tasks run
+            shared.clear()
+
+    return pd.concat(results, ignore_index=True)
+
+# Sweeps compute_rolling_returns over every security, time period and return period
+def sweep_rolling_returns(df, time_periods, return_periods, risk_free_rate, max_workers=None):
+    param_grid = {
+        'time_period': list(time_periods),
+        'return_periods': list(return_periods),
+        'risk_free_rate': [risk_free_rate]
+    }
+    return run_parallel(compute_rolling_returns, df, param_grid, max_workers=max_workers)
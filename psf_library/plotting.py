@@ -17,10 +17,16 @@ The point labels are added to each point on the line, and can be adjusted with t
 The table builder adds a table given information from a df and the location can be adjusted based on the needs for the graph
 '''
 
+# Gives the period end index for a security when they have been built with build_period_indexes
+def period_index(period_indexes, index):
+    if period_indexes is None:
+        return None
+    return period_indexes.get(index)
+
 #### Line Graphs ####
 
 # Allows for building simple line graphs on a specified subplot range
-def plot_basic_lines(index_list, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, quarterly=None, start_value=None, end_value=None):
+def plot_basic_lines(index_list, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, quarterly=None, start_value=None, end_value=None, period_indexes=None):
     # Sets up the subplot and axes for use
     fig, axes_array = plt.subplots(subplt_row, subplot_col, figsize=figsize, constrained_layout=True)
 
@@ -36,7 +42,7 @@ def plot_basic_lines(index_list, prepared_dataframes, column, row, subplt_row, s
     for i, index in enumerate(index_list):
         ax = axes[i]
         if (quarterly == True):
-            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value)
+            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value, period_index(period_indexes, index))
             dfs.append(df)
         else:
             df = prepared_dataframes[index]
@@ -51,7 +57,7 @@ def plot_basic_lines(index_list, prepared_dataframes, column, row, subplt_row, s
     return fig, axes, dfs
 
 # Allows for building colored line graphs on a specified subplot range
-def plot_colored_lines(index_list, colors, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, quarterly=None, start_value=None, end_value=None):
+def plot_colored_lines(index_list, colors, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, quarterly=None, start_value=None, end_value=None, period_indexes=None):
     fig, axes_array = plt.subplots(subplt_row, subplot_col, figsize=figsize, constrained_layout=True)
 
     if isinstance(axes_array, np.ndarray):
@@ -65,7 +71,7 @@ def plot_colored_lines(index_list, colors, prepared_dataframes, column, row, sub
     for i, (index, color) in enumerate(zip(index_list, colors)):
         ax = axes[i]
         if (quarterly == True):
-            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value)
+            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value, period_index(period_indexes, index))
             dfs.append(df)
         else:
             df = prepared_dataframes[index]
@@ -80,7 +86,7 @@ def plot_colored_lines(index_list, colors, prepared_dataframes, column, row, sub
     return fig, axes, dfs
 
 # Allows for building line graphs with a colored point on the lines on a specified subplot range
-def plot_scatter_lines(index_list, colors, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, mark, quarterly=None, start_value=None, end_value=None):
+def plot_scatter_lines(index_list, colors, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, mark, quarterly=None, start_value=None, end_value=None, period_indexes=None):
     fig, axes_array = plt.subplots(subplt_row, subplot_col, figsize=figsize, constrained_layout=True)
 
     if isinstance(axes_array, np.ndarray):
@@ -93,7 +99,7 @@ def plot_scatter_lines(index_list, colors, prepared_dataframes, column, row, sub
     for i, (index, color) in enumerate(zip(index_list, colors)):
         ax = axes[i]
         if (quarterly == True):
-            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value)
+            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value, period_index(period_indexes, index))
             dfs.append(df)
         else:
             df = prepared_dataframes[index]
@@ -110,7 +116,7 @@ def plot_scatter_lines(index_list, colors, prepared_dataframes, column, row, sub
 #### Scatterplots ####
 
 # Allows for building simple scatterplot on a specified subplot range
-def plot_basic_scatter(index_list, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, quarterly=None, start_value=None, end_value=None):
+def plot_basic_scatter(index_list, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, quarterly=None, start_value=None, end_value=None, period_indexes=None):
     # Sets up the subplot and axes for use
     fig, axes_array = plt.subplots(subplt_row, subplot_col, figsize=figsize, constrained_layout=True)
 
@@ -127,7 +133,7 @@ def plot_basic_scatter(index_list, prepared_dataframes, column, row, subplt_row,
         ax = axes[i]
         # Allows for specification of how many points wanted on subplot
         if (quarterly == True):
-            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value)
+            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value, period_index(period_indexes, index))
             dfs.append(df)
         else:
             df = prepared_dataframes[index]
@@ -142,7 +148,7 @@ def plot_basic_scatter(index_list, prepared_dataframes, column, row, subplt_row,
     return fig, axes, dfs
 
 # Allows for building colored scatterplots on a specified subplot range
-def plot_colored_scatter(index_list, colors, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, quarterly=None, start_value=None, end_value=None):
+def plot_colored_scatter(index_list, colors, prepared_dataframes, column, row, subplt_row, subplot_col, figsize, quarterly=None, start_value=None, end_value=None, period_indexes=None):
     fig, axes_array = plt.subplots(subplt_row, subplot_col, figsize=figsize, constrained_layout=True)
 
     if isinstance(axes_array, np.ndarray):
@@ -156,7 +162,7 @@ def plot_colored_scatter(index_list, colors, prepared_dataframes, column, row, s
     for i, (index, color) in enumerate(zip(index_list, colors)):
         ax = axes[i]
         if (quarterly == True):
-            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value)
+            df = get_last_day_each_quarter(prepared_dataframes[index], start_value, end_value, period_index(period_indexes, index))
             dfs.append(df)
         else:
             df = prepared_dataframes[index]
@@ -220,8 +226,9 @@ def plot_styled_table(raw_df, display_df, ax, width_scale, cmap=None, center=0,
 
     if delta_col_indices:
         # Iterates through the values and checks to make sure they are numbers
-        data_vals = raw_df.iloc[:, delta_col_indices].apply(
-            pd.to_numeric, errors='coerce').to_numpy().flatten()
+        numeric_vals = raw_df.iloc[:, delta_col_indices].apply(
+            pd.to_numeric, errors='coerce').to_numpy(dtype='float64')
+        data_vals = numeric_vals.flatten()
         data_vals = data_vals[~np.isnan(data_vals)]
 
         if len(data_vals) > 0:
@@ -232,11 +239,13 @@ def plot_styled_table(raw_df, display_df, ax, width_scale, cmap=None, center=0,
             # Loops over the rows 
             for i in range(raw_df.shape[0]):
                 # Loops over the specified column
-                for j in delta_col_indices:
+                for k, j in enumerate(delta_col_indices):
                     try:
-                        # Removes the formatting and turns to a float
-                        val_str = str(raw_df.iat[i, j]).replace('bps', '').replace('%', '').strip()
-                        val = float(val_str)
+                        # Raw numbers are used as they are, formatted text has the formatting removed first
+                        val = numeric_vals[i, k]
+                        if np.isnan(val):
+                            val_str = str(raw_df.iat[i, j]).replace('bps', '').replace('%', '').strip()
+                            val = float(val_str)
 
                         # Associates a color with the value and changes the background
                         color = cmap_func(norm(val))
@@ -310,8 +319,9 @@ def plot_styled_table_stacked(raw_df, display_df, ax, width_scale, cmap=None, ce
     ]
 
     if delta_col_indices:
-        data_vals = raw_df.iloc[:, delta_col_indices].apply(
-            pd.to_numeric, errors='coerce').to_numpy().flatten()
+        numeric_vals = raw_df.iloc[:, delta_col_indices].apply(
+            pd.to_numeric, errors='coerce').to_numpy(dtype='float64')
+        data_vals = numeric_vals.flatten()
         data_vals = data_vals[~np.isnan(data_vals)]
 
         if len(data_vals) > 0:
@@ -319,10 +329,12 @@ def plot_styled_table_stacked(raw_df, display_df, ax, width_scale, cmap=None, ce
             norm = TwoSlopeNorm(vmin=vmin, vcenter=center, vmax=vmax)
 
             for i in range(raw_df.shape[0]):
-                for j in delta_col_indices:
+                for k, j in enumerate(delta_col_indices):
                     try:
-                        val_str = str(raw_df.iat[i, j]).replace('bps', '').replace('%', '').strip()
-                        val = float(val_str)
+                        val = numeric_vals[i, k]
+                        if np.isnan(val):
+                            val_str = str(raw_df.iat[i, j]).replace('bps', '').replace('%', '').strip()
+                            val = float(val_str)
                         normed_val = norm(val)
                         color = cmap_func(normed_val)
                         rgba = to_rgba(color, alpha=0.7)
@@ -456,7 +468,7 @@ def point_label(indices, df, ax, location, xcord, ycord, value1=None, row=None,
 #################################
 
 # Calls all of the other building functions so that we can piece together the graphs, and the tables
-def annotate_on_lines(index_list, colors, prepared_dataframes, tables, column, row, subplt_row, subplot_col, figsize, putTables):
+def annotate_on_lines(index_list, colors, prepared_dataframes, tables, column, row, subplt_row, subplot_col, figsize, putTables, period_indexes=None):
     # fig, axes = create_subplots(subplt_row, subplot_col, figsize)
     fig, axes_array = plt.subplots(subplt_row, subplot_col, figsize=figsize, constrained_layout=True)
     
@@ -471,7 +483,7 @@ def annotate_on_lines(index_list, colors, prepared_dataframes, tables, column, r
         ax = axes[i]
 
         # Creates the cleaned and shortened dataframe based on the specific index
-        df = get_last_day_each_quarter(prepared_dataframes[index])
+        df = get_last_day_each_quarter(prepared_dataframes[index], period_index=period_index(period_indexes, index))
 
         # Plots the line graph with the points
 
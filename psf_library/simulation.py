@@ -0,0 +1,74 @@
+import pandas as pd
+import numpy as np
+from .calcs import periods_per_year
+from .dtypes import apply_result_dtype
+
+'''
+Builds simulated forward return paths from the history of a wide returns df
+Paths are made either by block bootstrapping the history or by drawing from a normal distribution fit to it
+The whole (paths x horizon x securities) array is worked through in chunks so memory stays bounded
+The metrics for every path match what compute_returns gives for a single series
+'''
+
+# Builds a chunk of simulated paths with shape (paths, horizon, securities)
+def simulate_paths(returns, horizon, n_paths, rng, method='bootstrap', block_size=20):
+    n_dates, n_securities = returns.shape
+
+    if method == 'bootstrap':
+        # Whole blocks of days are drawn together so short-term patterns and cross-security moves are kept
+        block_size = min(block_size, n_dates)
+        n_blocks = -(-horizon // block_size)
+        block_starts = rng.integers(0, n_dates - block_size + 1, size=(n_paths, n_blocks))
+        rows = (block_starts[:, :, None] + np.arange(block_size)).reshape(n_paths, -1)[:, :horizon]
+        return returns[rows]
+
+    elif method == 'parametric':
+        # Draws from a multivariate normal with the historical means and covariances
+        # eigh also works when the covariance is singular, like with duplicate series or more securities than dates
+        mean = returns.mean(axis=0)
+        covariance = np.atleast_2d(np.cov(returns, rowvar=False))
+        return rng.multivariate_normal(mean, covariance, size=(n_paths, horizon), method='eigh')
+
+    else:
+        raise ValueError("method must be 'bootstrap' or 'parametric'")
+
+# Simulates forward returns and gives the cumulative, annualized, volatility and Sharpe for every path and security
+def simulate_returns(df, horizon, n_paths, return_periods, risk_free_rate, method='bootstrap', block_size=20, seed=None, chunk_size=1000):
+    securities = [col for col in df.columns if col != 'date']
+    # Only days where every security has a return are used so the paths stay lined up
+    returns = df.sort_values('date')[securities].dropna().to_numpy(dtype='float64')
+    num_returns = periods_per_year(return_periods)
+
+    # A seeded generator gives the same paths every time
+    rng = np.random.default_rng(seed)
+
+    chunks = []
+    for start in range(0, n_paths, chunk_size):
+        paths = simulate_paths(returns, horizon, min(chunk_size, n_paths - start), rng, method, block_size)
+
+        cumulative_return = np.prod(1 + paths, axis=1) - 1
+        annualized = (1 + cumulative_return) ** (num_returns / horizon) - 1
+        volatility = paths.std(axis=1, ddof=1) * np.sqrt(num_returns)
+        sharpe_ratio = (annualized - risk_free_rate) / volatility
+
+        chunks.append(np.stack([cumulative_return, annualized, volatility, sharpe_ratio], axis=-1))
+
+    metrics = np.concatenate(chunks, axis=0)
+    n_securities = len(securities)
+
+    # Long format with one row for every path and security
+    return apply_result_dtype(pd.DataFrame({
+        'path': np.repeat(np.arange(n_paths), n_securities),
+        'security': np.tile(securities, n_paths),
+        'cumulative_return': metrics[:, :, 0].ravel(),
+        'annualized_return': metrics[:, :, 1].ravel(),
+        'volatility': metrics[:, :, 2].ravel(),
+        'sharpe_ratio': metrics[:, :, 3].ravel()
+    }))
+
+# Gives the percentiles of each simulated metric for every security
+def summarize_simulation(simulated, percentiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    metrics = ['cumulative_return', 'annualized_return', 'volatility', 'sharpe_ratio']
+    summary = simulated.groupby('security', sort=False, observed=True)[metrics].quantile(list(percentiles))
+    summary.index.names = ['security', 'percentile']
+    return summary